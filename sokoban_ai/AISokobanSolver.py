@@ -1,12 +1,16 @@
 from searchFunctions import *
-import asyncio
-import bisect
+from profiler import SearchStats
+import hashlib
+import time
+import heapq
+from collections import OrderedDict
+from itertools import count
 from mapa import Tiles
 from mapa import Map
 from copy import deepcopy
 
 class SearchNode:
-    def __init__(self, pos, parent=None, directions=(0,0), path="", strategy='bfs'):
+    def __init__(self, pos, parent=None, directions=(0,0), path=""):
         #position of the box that is going to be pushed
         self.pos = pos
         #direction of the box push
@@ -16,14 +20,11 @@ class SearchNode:
         self.heuristic = 0
         self.cost=0
         self.depth = 0
-        self.final_path = ""
-        self.strategy = strategy
+        #moves of the keeper from the parent, the whole path is only joined once the level is solved
+        self.path = path
         
         if parent is not None:
             self.depth = self.parent.depth + 1
-            self.path = path
-            self.cost=len(path) + self.parent.cost
-            self.final_path = f'{self.parent.final_path}{self.path}'
             self.cost = self.parent.cost + len(path)
             #list of parent boxes without the box being pushed
             lst_boxes={box for box in self.parent.boxes if box != self.pos}
@@ -33,7 +34,6 @@ class SearchNode:
         else:
             self.depth = 0
             self.cost = 0
-            self.final_path = ""
             self.heuristic = 0 
 
     def setHeuristic(self, storages):
@@ -42,48 +42,123 @@ class SearchNode:
     def __str__(self):
         return  "(" + str(self.pos) + ", " + str(self.directions) + ")"
 
-    def __lt__(self, other):
-        if self.strategy == 'bfs':
-            return self.depth  <  other.depth
-        elif self.strategy == 'a*':
-            return self.heuristic*2 + self.depth + self.cost < other.heuristic*2 + other.depth + other.cost
-        elif self.strategy == 'greedy':
-            return self.heuristic*2 + self.depth/3 < other.heuristic*2 + other.depth/3
 
+class PackedSearchNode:
+    """
+    Same as SearchNode, but for the packed representation used by PackedTreeSearch:
+    positions are linear indexes into the flattened map, the direction of the push is
+    the offset between two cells, and boxes is a bitset with one bit per cell.
+    Uses __slots__ so each node is a small fixed size object.
+    The path of the keeper isn't stored, a node is only its parent, the pushed box and the
+    direction of the push, the path is rebuilt once the level is solved (see PackedTreeSearch.solution_path)
+    """
+    __slots__ = ('pos', 'directions', 'parent', 'heuristic', 'cost', 'depth',
+                 'boxes', 'hash')
+
+    def __init__(self, pos, parent=None, directions=0, moves=0):
+        self.pos = pos
+        self.directions = directions
+        self.parent = parent
+        self.heuristic = 0
+
+        if parent is not None:
+            self.depth = parent.depth + 1
+            self.cost = parent.cost + moves
+            #a push only moves one box, so it only flips two bits
+            self.boxes = parent.boxes ^ (1 << pos) ^ (1 << (pos + directions))
+        else:
+            self.depth = 0
+            self.cost = 0
+
+    def __str__(self):
+        return  "(" + str(self.pos) + ", " + str(self.directions) + ")"
 
 
 class TreeSearch:
-    def __init__(self, mapa, level):
+    def __init__(self, mapa, level, verify_hash=False, strategy='bfs', change_strategy=True, weight=2, profile=False):
         self.level = level
         #initial strategy to solving levels
-        self.strategy = 'bfs'
-        self.change_strategy = True
+        self.strategy = strategy
+        #whether to go from bfs to a* and then to greedy as the search grows
+        self.change_strategy = change_strategy
+        self.started_astar = False
+        #weight of the heuristic in the a* and greedy priorities
+        self.weight = weight
+        #insertion counter, ties in the priority of the open nodes are popped in FIFO order
+        self.counter = count()
         
         self.map = mapa
         self.hor_tiles, self.ver_tiles = self.map.size
         self.storages = set(mapa.filter_tiles([Tiles.GOAL, Tiles.MAN_ON_GOAL, Tiles.BOX_ON_GOAL]))
-        self.storages_hash = hash(frozenset(self.storages))
-        
-        self.root = SearchNode(mapa.keeper)
-        self.root.boxes = mapa.boxes
-        #deque of nodes to explore with the root
-        self.open_nodes = deque([])
-        self.open_nodes.append(self.root)
+        #when set, states are only equal if their boxes are, not just their hashes
+        self.verify_hash = verify_hash
+        #zobrist table with a 64-bit key for each cell (y * hor_tiles + x) of the map
+        self.zobrist = zobrist_table(self.hor_tiles * self.ver_tiles, str(mapa))
+
+        self.static_analysis(mapa)
+        self.init_root(mapa)
+        self.non_terminals = 0
+        #nodes created by get_pushes
+        self.generated = 0
+        #pushes pruned because their state was already visited
+        self.duplicates = 0
+        #timers and counters of the search (see profiler.SearchStats), only when profile is set,
+        #True for the defaults or a SearchStats
+        self.stats = None
+        if profile:
+            self.stats = SearchStats() if profile is True else profile
+            self.stats.instrument(self)
 
+    def static_analysis(self, mapa):
+        """
+        Analysis of the map that doesn't depend on the state of the boxes
+        """
         #matrix of deadsquares
         self.deadsquares = self.simple_deadlock()
         #matrix of all reachable positions by the keeper without taking in consideration the boxes
-        self.reachable_area = initial_reachable_area(self.root.pos, mapa)
-        # #dictionary with storage as a key and a matrix with all the distances to this storage
-        # self.heuristic_stor = calc_pos_heuristic(self.storages, self.map, self.deadsquares)
-        #backtrack that stores hashes of boxes and a list of the keepers' positions
-        self.backtrack_pos = {hash(frozenset(self.root.boxes)): [self.root.pos]}
-        self.non_terminals = 0
+        self.reachable_area = initial_reachable_area(mapa.keeper, mapa)
+
+    def init_root(self, mapa):
+        """
+        Creates the root node from the initial state of the map, the queue of open nodes
+        and the backtrack dictionary
+        """
+        self.storages_hash = self.state_key(self.zobrist_hash(self.storages), self.storages)
+
+        self.root = SearchNode(mapa.keeper)
+        self.root.boxes = mapa.boxes
+        self.root.hash = self.zobrist_hash(self.root.boxes)
+        #heap of (priority, insertion counter, node) of the nodes to explore with the root
+        self.open_nodes = []
+        self.add_to_open([self.root], self.open_nodes)
+
+        #backtrack that stores the visited states, the key of the boxes and the normalized keeper position
+        self.backtrack_pos = {(self.state_key(self.root.hash, self.root.boxes), self.normalized_keeper(self.root))}
+
+    def zobrist_hash(self, positions):
+        """
+        @param positions: an iterable with the (x, y) positions of the boxes
+        Returns the zobrist hash of these boxes
+        """
+        hor_tiles = self.hor_tiles
+        return zobrist_hash((y * hor_tiles + x for x, y in positions), self.zobrist)
+
+    def state_key(self, hash_boxes, boxes):
+        """
+        @param hash_boxes: the zobrist hash of the boxes
+        @param boxes: the boxes positions
+        Returns the key of these boxes for completed() and the backtrack dictionary.
+        By default it's only the 64-bit hash, with verify_hash the boxes are part of the key too,
+        so a hash collision can never make two different states equal
+        """
+        if self.verify_hash:
+            return hash_boxes, frozenset(boxes)
+        return hash_boxes
 
     def completed(self, hash_boxes):
         """
-        @param hash_boxes: a hash of the set of the boxes current positions
-        Returns a boolean value, if the hash of the storages equals  the hash passed as parameter then the map is completed
+        @param hash_boxes: the key (see state_key) of the boxes current positions
+        Returns a boolean value, if the key of the storages equals the key passed as parameter then the map is completed
         """
         return self.storages_hash == hash_boxes
 
@@ -93,81 +168,81 @@ class TreeSearch:
         Function that fills an bidimensional array with 1's if the player can reach a position
         or leave it at value 0 if it is a simple deadlock
         """
-        def recursive(cur):
-            """
-            We start this minimal Breadth first search on the coordinates of each storage.
-            If a position is blocked vertically and horizontally by a Wall(Identified by 0b1000), then that any push of a box
-            to that position results in a Simple Deadlock. Since any wall is Identified by the constant value "8" , doing the AND 
-            bitwise operation can check if the position is a Wall : 1*2³ + 0*2² + ...
-            """
-            x, y = cur
+        map = self.map
+        hor_tiles = self.hor_tiles
+        ver_tiles = self.ver_tiles
+        #Initialization of the bidimensional array
+        vis_geral = [[0] * hor_tiles for _ in range(ver_tiles)]
+
+        #We start this search on the coordinates of each storage, pulling a box away from it.
+        #If a position is blocked vertically and horizontally by a Wall(Identified by 0b1000), then that any push of a box
+        #to that position results in a Simple Deadlock. It uses a stack instead of recursion, so large open maps can't
+        #reach the recursion limit
+        stack = list(self.storages)
+        while stack:
+            x, y = stack.pop()
             #avoid going to the same position more than once
-            if vis_geral[y][x] or self.map.get_tile(cur) & 0b1000:
-                return
+            if vis_geral[y][x] or map.get_tile((x, y)) & 0b1000:
+                continue
 
             vis_geral[y][x] = 1
 
             if 0 < y + 2 < ver_tiles and not (map.get_tile((x, y + 2)) & 0b1000):
-                recursive((x, y + 1))
+                stack.append((x, y + 1))
             if 0 < x + 2 < hor_tiles and not (map.get_tile((x + 2, y)) & 0b1000):
-                recursive((x + 1, y))
+                stack.append((x + 1, y))
             if 0 < y - 2 < ver_tiles and not (map.get_tile((x, y - 2)) & 0b1000):
-                recursive((x, y - 1))
+                stack.append((x, y - 1))
             if 0 < x - 2 < hor_tiles and not (map.get_tile((x - 2, y)) & 0b1000):
-                recursive((x - 1, y))
-            return
-
-        map = self.map
-        hor_tiles = self.hor_tiles
-        ver_tiles = self.ver_tiles
-        #Initialization of the bidimensional array
-        vis_geral = [[0] * hor_tiles for _ in range(ver_tiles)]
-
-        for storage in self.storages:
-            recursive(storage)
+                stack.append((x - 1, y))
 
         return vis_geral
 
 
+    def normalized_keeper(self, node):
+        """
+        @param node: a node object of the class Node
+        Returns the top-left position (as y * hor_tiles + x) the keeper can reach on this node.
+        Every keeper position that can reach each other has the same normalized position
+        """
+        reach_pos = reachable_positions(node.pos, self.map, node.boxes)
+        for y, line in enumerate(reach_pos):
+            if 1 in line:
+                return y * self.hor_tiles + line.index(1)
+
     def check_backtrack(self, node, key):
         """
         @param node: a node object of the class Node
-        @param key: a hash of the boxes positions 
-        Check if the next push was already visited, we keep a dictionary with the states we've already been
-        as a key, the value is a list of the keepers' positions.
+        @param key: the key (see state_key) of the boxes positions
+        Check if the next push was already visited, we keep a set with the states we've already been,
+        a state is the key of the boxes and the normalized keeper position, so this is a single lookup.
         Returns a boolean value, False if we already been throug this State, or True in the other scenario
         """
-        keeper = node.pos
-        backtrack_pos = self.backtrack_pos
+        state = key, self.normalized_keeper(node)
 
-        if key in backtrack_pos:
-            if any(bfs(keeper, (dx, dy), self.map, node.boxes) is not None for dx, dy in backtrack_pos[key]):
-                return False
-            backtrack_pos[key].append(keeper)
-        else:
-            backtrack_pos[key] = deque([keeper])
+        if state in self.backtrack_pos:
+            self.duplicates += 1
+            return False
+        self.backtrack_pos.add(state)
         return True
 
 
-    async def search(self):
+    def search(self, timeout=None):
         """
         Main search function where it is popped one node of the open nodes queue.
         According to the current number of non-terminal nodes and terminal nodes, we may change
-        the heuristic-based strategy that we will be using to "order" the nodes in this queue
+        the heuristic-based strategy that we will be using to "order" the nodes in this queue.
+        It never yields, run it on a worker thread or process to keep an event loop responsive
+        @param timeout: seconds after which the search gives up
+        Returns the keys that solve the level, or None if there's no solution or time ran out
         """
-        started_astar = False
-        while self.open_nodes != []:
-            await asyncio.sleep(0)
-            node = self.open_nodes.popleft()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.open_nodes:
+            if deadline is not None and time.monotonic() > deadline:
+                return None
+            node = heapq.heappop(self.open_nodes)[2]
             self.non_terminals += 1
-            if self.change_strategy:
-                if not started_astar:
-                    if 7000 <= self.non_terminals <= 12000:
-                        self.strategy = "a*"
-                        started_astar = True
-                elif 12000 < self.non_terminals:
-                    self.strategy = "greedy"
-                    self.change_strategy=False
+            self.update_strategy()
 
             poss_pushes, completed = self.get_pushes(node)
             
@@ -175,14 +250,42 @@ class TreeSearch:
                 #it the current state has not every box in a goal then we will expand the remaining nodes in the queue
                 self.add_to_open(poss_pushes, self.open_nodes)
             else:
-                #we get the final_path to achieve the solution of the level stored as an attribute of the Node
+                #we get the final_path to achieve the solution of the level from the last Node
                 node = poss_pushes.pop(0)
+                final_path = self.solution_path(node)
                 print(self.level)
-                print(node.final_path)
-                print("steps",len(node.final_path))
+                print(final_path)
+                print("steps",len(final_path))
                 print("depth",node.depth)
                 print("non_terminals", self.non_terminals)
-                return node.final_path
+                print("duplicates", self.duplicates)
+                return final_path
+
+    def update_strategy(self):
+        """
+        Changes the strategy according to the number of non-terminal nodes, from bfs to a* and then to greedy
+        """
+        if self.change_strategy:
+            if not self.started_astar:
+                if 7000 <= self.non_terminals <= 12000:
+                    self.strategy = "a*"
+                    self.started_astar = True
+                    self.reprioritize(self.open_nodes)
+            elif 12000 < self.non_terminals:
+                self.strategy = "greedy"
+                self.change_strategy=False
+                self.reprioritize(self.open_nodes)
+
+    def solution_path(self, node):
+        """
+        @param node: the node that completes the level
+        Returns the string with all the moves of the keeper to get from the root to this node
+        """
+        paths = []
+        while node is not None:
+            paths.append(node.path)
+            node = node.parent
+        return "".join(reversed(paths))
 
     def get_pushes(self, node):
         '''
@@ -193,26 +296,31 @@ class TreeSearch:
         pushes = deque([])
 
         #call the function that gets a bidimensional array with the reachable positions by the keeper, in the current state
-        node.reach_pos = reachable_positions(node.pos, self.map, node.boxes)
+        reach_pos = self.keeper_tree(node)
+        hor_tiles = self.hor_tiles
+        zobrist = self.zobrist
         #the boxes that we will iterate will be returned by the function find_coral_boxes
-        for x, y in self.find_coral_boxes(node.reach_pos, node.boxes, self.storages, self.map, self.deadsquares):
+        for x, y in self.find_coral_boxes(reach_pos, node.boxes, node.hash, self.storages, self.map, self.deadsquares):
             for dx, dy, d in [(-1, 0, "a"), (0, 1, "s"), (1, 0, "d"), (0, -1, "w")]:
                 if (
-                    node.reach_pos[y-dy][x-dx] #check if the keeper can reach the position to make this push
+                    reach_pos[y-dy][x-dx] #check if the keeper can reach the position to make this push
                     and not self.map._map[y + dy][x + dx] & 0b1000 #avoid pushing towards a wall
                     and not (x+dx, y+dy) in node.boxes #avoid pushing towards a box
                     and self.deadsquares[y+dy][x+dx]): #avoid pushing to a deadsquare
 
                     #call to the function that returns the path that the keeper has to do in order to do this push
                     #if the path is None then this push is not possible
-                    path = bfs(node.pos,(x-dx, y-dy), self.map, node.boxes)
+                    path = self.keeper_path(node, (x-dx, y-dy))
                     if path is None:
                         continue
                     #create a node
-                    temp_node = SearchNode((x,y), node, (dx,dy), f'{path}{d}', self.strategy)
+                    temp_node = SearchNode((x,y), node, (dx,dy), f'{path}{d}')
+                    self.generated += 1
+
+                    #the pushed box leaves one cell and enters another, two XORs update the hash
+                    temp_node.hash = node.hash ^ zobrist[y * hor_tiles + x] ^ zobrist[(y + dy) * hor_tiles + x + dx]
+                    hash_boxes = self.state_key(temp_node.hash, temp_node.boxes)
 
-                    hash_boxes = hash(frozenset(temp_node.boxes))
-                    
                     #check if map is already completed
                     if self.completed(hash_boxes):
                         return [temp_node], True
@@ -225,13 +333,30 @@ class TreeSearch:
 
         return pushes, False
 
-    def find_coral_boxes(self, reach_pos, boxes, storages, map, deadsquares):
+    def keeper_tree(self, node):
+        """
+        @param node: a node object of the class Node
+        Returns the bidimensional array of the positions the keeper can reach on this node
+        """
+        return reachable_positions(node.pos, self.map, node.boxes)
+
+    def keeper_path(self, node, pos):
+        """
+        @param node: a node object of the class Node
+        @param pos: the position the keeper walks to
+        Returns the moves of the keeper from its position on this node to pos, or None if it can't get there
+        """
+        return bfs(node.pos, pos, self.map, node.boxes)
+
+    def find_coral_boxes(self, reach_pos, boxes, hash_boxes, storages, map, deadsquares):
         '''
+        @param hash_boxes: the zobrist hash of boxes
         Returns boxes that are on the edges of a Pi-corral or all boxes if there isn't a Pi-corral (also works with multi-room Pi-corrals).
         '''
         coral_pos_set = set()
         ver_tiles = self.ver_tiles
         hor_tiles = self.hor_tiles
+        zobrist = self.zobrist
 
         #find corrals by comparing if a position (that doesn't have a box) was reachable
         #on the initial state of the level and on this node state it's not
@@ -275,7 +400,8 @@ class TreeSearch:
                                 
                                 new_push_boxes.add((push_x, push_y))
                                 #check if this solves the level
-                                if self.completed(hash(frozenset(new_push_boxes))):
+                                push_hash = hash_boxes ^ zobrist[yy * hor_tiles + xx] ^ zobrist[push_y * hor_tiles + push_x]
+                                if self.completed(self.state_key(push_hash, new_push_boxes)):
                                     return boxes
                                 #check for freeze deadlocks
                                 if not self.freeze_deadlock((push_x, push_y), new_push_boxes, storages, map, deadsquares):
@@ -332,12 +458,12 @@ class TreeSearch:
             if not deadsquares[y][x+1] and not deadsquares[y][x-1]:
                 blocked_x = True
             #check if is blocked in the x axis by a wall(different from simple deadlocks!those are blocked in BOTH axis by a wall)    
-            elif map.get_tile((x+1, y)) & 0b1000 or map.get_tile((x-1, y)) & 0b1000:
+            elif map._map[y][x+1] & 0b1000 or map._map[y][x-1] & 0b1000:
                 blocked_x = True
             #the same of the y axis
             if not deadsquares[y+1][x] and not deadsquares[y-1][x]:
                 blocked_y = True
-            elif map.get_tile((x, y+1)) & 0b1000 or map.get_tile((x, y-1)) & 0b1000:
+            elif map._map[y+1][x] & 0b1000 or map._map[y-1][x] & 0b1000:
                 blocked_y = True
 
 
@@ -385,11 +511,681 @@ class TreeSearch:
         return True
 
 
+    def priority(self, node):
+        """
+        @param node: a node object
+        Returns the priority of the node for the current strategy, the lowest is expanded first
+        """
+        if self.strategy == 'bfs':
+            return node.depth
+        elif self.strategy == 'a*':
+            return node.heuristic*self.weight + node.depth + node.cost
+        elif self.strategy == 'greedy':
+            return node.heuristic*self.weight + node.depth/3
+
     def add_to_open(self, pushes, open_nodes):
         '''
         @param pushes- the valid new  pushes for this node's state
-        Places the pushes one by one maintaining always the order.
+        Pushes each node to the heap of open nodes with its priority, computed once.
         '''
+        priority = self.priority
+        counter = self.counter
         for push in pushes:
-            #we do not need to sort all list, only put in the right place each push, therefore we use the bisect module
-            bisect.insort( open_nodes, push )
\ No newline at end of file
+            heapq.heappush(open_nodes, (priority(push), next(counter), push))
+
+    def reprioritize(self, open_nodes):
+        '''
+        @param open_nodes: a heap of open nodes, rebuilt in place
+        Recomputes the priority of every open node after a change of strategy, keeping the
+        insertion counters so ties are still popped in FIFO order
+        '''
+        priority = self.priority
+        open_nodes[:] = [(priority(node), order, node) for _, order, node in open_nodes]
+        heapq.heapify(open_nodes)
+
+
+class PackedTreeSearch(TreeSearch):
+    """
+    TreeSearch over the packed state representation: the map is flattened into bytearrays
+    indexed by y * hor_tiles + x and every node keeps its boxes as a bitset (PackedSearchNode).
+
+    @param heuristic: 'push' for the sum of the push distances of each box to its closest goal,
+    an admissible lower bound that takes walls into account, 'matching' for the push distances of
+    the minimum cost matching between boxes and goals, a tighter (and slower) admissible lower bound,
+    or 'manhattan' for greedy_heur
+    @param matching_cache_size: how many matchings are kept, the least recently used are dropped
+    @param freeze_cache_size: how many freeze deadlock results are kept, the least recently used are dropped
+    @param macros: whether a push into a tunnel goes on to its end and a push into the entrance of a goal room
+    goes on to the next goal of the room, as a single node
+    @param bidirectional: whether a backward search of pulls from the goals runs along with the search of pushes
+    @param max_states: both searches stop once they keep this many visited states between them
+    The other keyword arguments are the ones of TreeSearch
+    """
+    def __init__(self, mapa, level, heuristic='push', matching_cache_size=2**16, freeze_cache_size=2**16,
+                 macros=True, bidirectional=False, max_states=10**6, **kwargs):
+        self.heuristic = heuristic
+        self.macros = macros
+        self.bidirectional = bidirectional
+        self.max_states = max_states
+        #matching lower bound of the boxes already seen, by the key of the boxes
+        self.matching_cache = OrderedDict()
+        self.matching_cache_size = matching_cache_size
+        #freeze_deadlock of the box windows already seen
+        self.freeze_cache = OrderedDict()
+        self.freeze_cache_size = freeze_cache_size
+        super().__init__(mapa, level, **kwargs)
+
+    def static_analysis(self, mapa):
+        """
+        Same as TreeSearch.static_analysis, over the flattened map, plus the push distance tables.
+        It only depends on the level, so it's cached by the content hash of the map, in memory
+        and on disk, and starting the same level again skips it
+        """
+        key = hashlib.sha1(str(mapa).encode()).hexdigest()
+        analysis = cached_static_analysis(key, lambda: self.analyse_map(mapa))
+
+        self.walls = analysis["walls"]
+        self.deadsquares = analysis["deadsquares"]
+        self.reachable_area = analysis["reachable_area"]
+        self.storage_cells = analysis["storage_cells"]
+        #push distances from every position to each goal (in the order of storage_cells), and to the closest one
+        self.goal_distances = analysis["goal_distances"]
+        self.closest_goal = analysis["closest_goal"]
+        #by (entrance, direction) of each goal room: the bitset of its goals and the pushes of each step, see goal_room_macros
+        self.goal_rooms = analysis["goal_rooms"]
+        #deadlock patterns mined offline for this map (see deadlocks.py), if any
+        self.deadlock_patterns = load_deadlock_patterns(key)
+        #positions the keeper can't reach on a state without corrals: the ones outside of reachable_area and the boxes
+        self.unreachable_cells = len(self.walls) - self.reachable_area.count(1) + len(mapa.boxes)
+
+    def analyse_map(self, mapa):
+        """
+        Computes the static analysis of the map, see static_analysis
+        """
+        hor_tiles = self.hor_tiles
+        walls = flatten_walls(mapa)
+        storage_cells = sorted(y * hor_tiles + x for x, y in self.storages)
+        keeper_x, keeper_y = mapa.keeper
+        goal_distances, closest_goal = push_distance_tables(walls, storage_cells, hor_tiles)
+        goal_rooms = {}
+        for room, entrance in flat_goal_rooms(walls, storage_cells, hor_tiles):
+            for offset in (-hor_tiles, -1, hor_tiles, 1):
+                steps = goal_room_macros(room, entrance, offset, walls, hor_tiles)
+                if steps is not None:
+                    goal_rooms[entrance, offset] = sum(1 << cell for cell in room), steps
+        return {
+            "walls": walls,
+            "deadsquares": flat_deadsquares(walls, storage_cells, hor_tiles),
+            #without boxes, the keeper reaches the same positions as initial_reachable_area
+            "reachable_area": flat_reachable_positions(keeper_y * hor_tiles + keeper_x, walls, 0, hor_tiles),
+            "storage_cells": storage_cells,
+            "goal_distances": goal_distances,
+            "closest_goal": closest_goal,
+            "goal_rooms": goal_rooms,
+        }
+
+    def init_root(self, mapa):
+        """
+        Creates the packed root node
+        """
+        hor_tiles = self.hor_tiles
+        #offsets of each push, in the same order as TreeSearch.get_pushes
+        self.directions = [(-1, "a"), (hor_tiles, "s"), (1, "d"), (-hor_tiles, "w")]
+        self.push_keys = dict(self.directions)
+        #the boxes bitset shifted left by freeze_padding and right by a position has the 5x5 window around
+        #that position on the bits of freeze_window, even for the positions next to the top border
+        self.freeze_padding = 2 * hor_tiles + 2
+        self.freeze_window = sum(0b11111 << row * hor_tiles for row in range(5))
+        #the 3x3 positions around each position
+        self.freeze_around = [{pos + dy + dx for dy in (-hor_tiles, 0, hor_tiles) for dx in (-1, 0, 1)}
+                              for pos in range(len(self.walls))]
+        #the 8 positions around each position, deadlock patterns are groups of boxes around each other
+        self.pattern_neighbours = [(pos - hor_tiles - 1, pos - hor_tiles, pos - hor_tiles + 1, pos - 1, pos + 1,
+                                    pos + hor_tiles - 1, pos + hor_tiles, pos + hor_tiles + 1)
+                                   for pos in range(len(self.walls))]
+        #zobrist hashes of the deadlock patterns and of the groups of boxes inside them
+        self.pattern_keys, self.pattern_subkeys = deadlock_pattern_keys(
+            self.deadlock_patterns, self.pattern_neighbours, self.zobrist)
+        #bitset of each position and the ones next to it
+        self.freeze_cross = [sum(1 << cell for cell in (pos, pos - 1, pos + 1, pos - hor_tiles, pos + hor_tiles) if cell >= 0)
+                             for pos in range(len(self.walls))]
+        self.init_macros()
+
+        self.storages = pack_cells(self.storages, hor_tiles)
+        self.storages_hash = self.state_key(zobrist_hash(self.storage_cells, self.zobrist), self.storages)
+
+        keeper_x, keeper_y = mapa.keeper
+        self.root = PackedSearchNode(keeper_y * hor_tiles + keeper_x)
+        self.root.boxes = pack_cells(mapa.boxes, hor_tiles)
+        self.root.hash = zobrist_hash(unpack_cells(self.root.boxes), self.zobrist)
+        self.root.heuristic = self.node_heuristic(self.root)
+        self.open_nodes = []
+        self.add_to_open([self.root], self.open_nodes)
+        self.backtrack_pos = {(self.state_key(self.root.hash, self.root.boxes), self.normalized_keeper(self.root))}
+        if self.bidirectional:
+            self.init_backward()
+
+    def init_macros(self):
+        """
+        Finds the tunnels of the map and marks, for each direction, the positions where a push starts a macro.
+        A box is in a tunnel when both it and the keeper behind it have walls on both sides, then pushing it on
+        is the only thing left to do with it, so it's pushed until it leaves the tunnel, gets to a goal or is blocked
+        """
+        hor_tiles, walls = self.hor_tiles, self.walls
+        goals = set(self.storage_cells)
+        #(position, direction) of every tunnel
+        self.tunnels = set()
+        #by direction, a 1 on the positions a box pushed in that direction starts a tunnel or goal room macro from
+        self.macro_starts = {offset: bytearray(len(walls)) for offset, d in self.directions}
+        #pushes of each macro already made, by the box it started from, the keeper and the direction it ends with
+        self.macro_pushes = {}
+        if not self.macros:
+            return
+
+        for offset, d in self.directions:
+            side = 1 if abs(offset) == hor_tiles else hor_tiles
+            for pos in range(len(walls)):
+                keeper = pos - offset
+                if (0 <= keeper < len(walls) and not walls[pos] and not walls[keeper] and pos not in goals
+                    and walls[pos - side] and walls[pos + side] and walls[keeper - side] and walls[keeper + side]):
+                    self.tunnels.add((pos, offset))
+                    self.macro_starts[offset][pos] = 1
+        for entrance, offset in self.goal_rooms:
+            self.macro_starts[offset][entrance] = 1
+
+    def macro(self, box, dest, offset, boxes):
+        """
+        @param box: the position of a box pushed in the direction offset to dest, a position macro_starts marks
+        @param boxes: bitset of the boxes positions before the push
+        Pushes the box on through the tunnel or into the goal room it's in
+        Returns the new position of the box, the position of the keeper, the direction of the last push and the
+        moves of the pushes after the first one
+        """
+        walls, deadsquares = self.walls, self.deadsquares
+        keeper, moves = box, 0
+        while True:
+            room = self.goal_rooms.get((dest, offset))
+            if room is not None:
+                step = room[1].get(boxes & room[0])
+                if step is not None:
+                    goal, room_pushes, room_moves = step
+                    #the first push of the room is the one to the entrance
+                    pushes = [(cell, offset) for cell in range(box, dest, offset)] + list(room_pushes)
+                    keeper, offset = pushes[-1]
+                    self.macro_pushes[box, keeper, offset] = pushes
+                    return goal, keeper, offset, moves + room_moves
+            nxt = dest + offset
+            if (dest, offset) not in self.tunnels or walls[nxt] or boxes >> nxt & 1 or not deadsquares[nxt]:
+                break
+            keeper, dest = dest, nxt
+            moves += 1
+        if keeper != box:
+            self.macro_pushes[box, keeper, offset] = [(cell, offset) for cell in range(box, dest, offset)]
+        return dest, keeper, offset, moves
+
+    def state_key(self, hash_boxes, boxes):
+        """
+        Same as TreeSearch.state_key, the bitset of boxes is already an immutable exact key
+        """
+        if self.verify_hash:
+            return hash_boxes, boxes
+        return hash_boxes
+
+    def normalized_keeper(self, node):
+        """
+        Same as TreeSearch.normalized_keeper, the first reachable cell of the flattened map
+        """
+        return flat_reachable_positions(node.pos, self.walls, node.boxes, self.hor_tiles).find(1)
+
+    def get_pushes(self, node):
+        '''
+        Same as TreeSearch.get_pushes, over linear indexes and bitsets
+        '''
+        pushes = deque([])
+        walls = self.walls
+        deadsquares = self.deadsquares
+        boxes = node.boxes
+
+        #a single bfs gives both the reachable positions and the number of moves to each push
+        reach_pos, distances = self.keeper_tree(node)
+        zobrist = self.zobrist
+        macro_starts = self.macro_starts
+        for box in self.find_coral_boxes(reach_pos, boxes, node.hash, self.storages, walls, deadsquares):
+            for offset, d in self.directions:
+                dest = box + offset
+                if (
+                    reach_pos[box - offset] >= 0 #check if the keeper can reach the position to make this push
+                    and not walls[dest] #avoid pushing towards a wall
+                    and not boxes >> dest & 1 #avoid pushing towards a box
+                    and deadsquares[dest]): #avoid pushing to a deadsquare
+
+                    if macro_starts[offset][dest]:
+                        dest, keeper, last, moves = self.macro(box, dest, offset, boxes)
+                        temp_node = PackedSearchNode(keeper, node, last, distances[box - offset] + 1 + moves)
+                        temp_node.boxes = boxes ^ (1 << box) ^ (1 << dest)
+                    else:
+                        #the keeper walks to the position behind the box and pushes it
+                        temp_node = PackedSearchNode(box, node, offset, distances[box - offset] + 1)
+                    self.generated += 1
+                    temp_node.hash = node.hash ^ zobrist[box] ^ zobrist[dest]
+                    hash_boxes = self.state_key(temp_node.hash, temp_node.boxes)
+
+                    if self.completed(hash_boxes):
+                        return [temp_node], True
+                    if (self.check_backtrack(temp_node, hash_boxes)
+                        and not self.freeze_deadlock(dest, temp_node.boxes, self.storages, walls, deadsquares)):
+                        #most patterns are freeze deadlocks too, only the states that aren't get looked up
+                        if self.deadlock_patterns and self.pattern_deadlock(dest, temp_node.boxes):
+                            continue
+                        temp_node.heuristic = self.node_heuristic(temp_node)
+                        #no matching of boxes to goals, no push can ever solve this state
+                        if temp_node.heuristic == float("inf"):
+                            continue
+                        pushes.append(temp_node)
+
+        return pushes, False
+
+    def pattern_deadlock(self, pos, boxes):
+        """
+        @param pos: the new position of the pushed box
+        @param boxes: bitset of the boxes positions after the push
+        Returns a boolean value, True if the pushed box is part of a deadlock pattern
+        """
+        return flat_pattern_deadlock(pos, boxes, self.pattern_keys, self.pattern_subkeys, self.pattern_neighbours,
+                                     self.zobrist)
+
+    def keeper_tree(self, node):
+        """
+        Same as TreeSearch.keeper_tree, returns the previous position of each position of the keeper tree
+        (-1 if the keeper can't reach it) and the number of moves to each one, see flat_keeper_tree
+        """
+        return flat_keeper_tree(node.pos, self.walls, node.boxes, self.hor_tiles)
+
+    def init_backward(self):
+        """
+        Creates the roots of the backward search, every box on a goal with the keeper on each region
+        those boxes split the level into, and its queue of open nodes and visited states.
+        A backward node is the push that undoes its pull: pos is the position the box was pulled to and
+        directions the way it's pushed back, so the keeper stands at pos - directions
+        """
+        hor_tiles, walls = self.hor_tiles, self.walls
+        #the visited states of the forward search keep their node, to rebuild the pushes once both meet
+        self.backtrack_pos = {state: self.root for state in self.backtrack_pos}
+        self.check_backtrack = self.check_meeting
+        #the forward and backward nodes of the state where both searches met
+        self.meeting = None
+
+        #pulls from the initial positions of the boxes, a box is never pulled where it can't be pushed to
+        starts = [pull_distances(box, walls, hor_tiles) for box in unpack_cells(self.root.boxes)]
+        self.start_distances = [min((table[cell] for table in starts if table[cell] is not None), default=None)
+                                for cell in range(len(walls))]
+
+        self.backward_open = []
+        self.backward_states = {}
+        goal_boxes = self.storages
+        goal_hash = zobrist_hash(self.storage_cells, self.zobrist)
+        for cell, reachable in enumerate(self.reachable_area):
+            if not reachable or goal_boxes >> cell & 1:
+                continue
+            root = PackedSearchNode(cell)
+            root.boxes = goal_boxes
+            root.hash = goal_hash
+            state = self.state_key(goal_hash, goal_boxes), self.backward_keeper(root)
+            if state not in self.backward_states:
+                root.heuristic = sum(self.start_distances[box] or 0 for box in self.storage_cells)
+                self.backward_states[state] = root
+                self.add_to_open([root], self.backward_open)
+
+    def backward_keeper(self, node):
+        """
+        Same as normalized_keeper, for a node of the backward search
+        """
+        return flat_reachable_positions(node.pos - node.directions, self.walls, node.boxes, self.hor_tiles).find(1)
+
+    def check_meeting(self, node, key):
+        """
+        Same as TreeSearch.check_backtrack, for the bidirectional search: the state keeps its node and, when
+        the backward search visited it already, both searches met
+        """
+        state = key, self.normalized_keeper(node)
+        if state in self.backtrack_pos:
+            self.duplicates += 1
+            return False
+        self.backtrack_pos[state] = node
+        if state in self.backward_states:
+            self.meeting = node, self.backward_states[state]
+        return True
+
+    def get_pulls(self, node):
+        """
+        Calculates the pulls of a node of the backward search, the same way as get_pushes: the keeper stands
+        next to a box, walks one position away from it and the box follows. Pulls to positions the box can't
+        be pushed to from the initial state are pruned
+        Returns the new nodes, the search met the forward one if self.meeting is set
+        """
+        pulls = []
+        walls, hor_tiles = self.walls, self.hor_tiles
+        boxes = node.boxes
+        start_distances = self.start_distances
+        zobrist = self.zobrist
+        reach_pos, distances = flat_keeper_tree(node.pos - node.directions, walls, boxes, hor_tiles)
+        for box in unpack_cells(boxes):
+            for offset, d in self.directions:
+                #the keeper goes from dest to dest + offset, the box from box to dest
+                dest = box + offset
+                if (reach_pos[dest] >= 0
+                    and not walls[dest + offset]
+                    and not boxes >> (dest + offset) & 1
+                    and start_distances[dest] is not None):
+
+                    temp_node = PackedSearchNode(dest, node, -offset, distances[dest] + 1)
+                    self.generated += 1
+                    temp_node.hash = node.hash ^ zobrist[box] ^ zobrist[dest]
+                    state = self.state_key(temp_node.hash, temp_node.boxes), self.backward_keeper(temp_node)
+                    if state in self.backward_states:
+                        self.duplicates += 1
+                        continue
+                    self.backward_states[state] = temp_node
+                    temp_node.heuristic = node.heuristic - start_distances[box] + start_distances[dest]
+                    pulls.append(temp_node)
+                    if state in self.backtrack_pos:
+                        self.meeting = self.backtrack_pos[state], temp_node
+                        return pulls
+        return pulls
+
+    def search(self, timeout=None):
+        """
+        Same as TreeSearch.search, or bidirectional_search if bidirectional is set
+        """
+        if self.bidirectional:
+            return self.bidirectional_search(None if timeout is None else time.monotonic() + timeout)
+        return super().search(timeout)
+
+    def bidirectional_search(self, deadline):
+        """
+        Same as TreeSearch.search, expanding a node of the forward search or of the backward one, the one
+        with fewer visited states, until a state is visited by both
+        Returns the keys that solve the level, or None if there's no solution, time ran out or both searches
+        visited max_states states
+        """
+        while self.open_nodes or self.backward_open:
+            if deadline is not None and time.monotonic() > deadline:
+                return None
+            if len(self.backtrack_pos) + len(self.backward_states) > self.max_states:
+                return None
+
+            self.non_terminals += 1
+            strategy = self.strategy
+            self.update_strategy()
+            if self.strategy != strategy:
+                #update_strategy only rescored the forward nodes
+                self.reprioritize(self.backward_open)
+            if self.backward_open and (not self.open_nodes or len(self.backward_states) < len(self.backtrack_pos)):
+                node = heapq.heappop(self.backward_open)[2]
+                self.add_to_open(self.get_pulls(node), self.backward_open)
+            else:
+                node = heapq.heappop(self.open_nodes)[2]
+                poss_pushes, completed = self.get_pushes(node)
+                if completed:
+                    return self.solution_path(poss_pushes[0])
+                self.add_to_open(poss_pushes, self.open_nodes)
+
+            if self.meeting is not None:
+                forward, backward = self.meeting
+                pushes = self.push_history(forward)
+                #the pushes that undo the pulls, from the meeting state to the goals
+                while backward.parent is not None:
+                    pushes.append((backward.pos, backward.directions))
+                    backward = backward.parent
+                return self.replay(pushes)
+
+    def node_heuristic(self, node):
+        """
+        @param node: a node object of the class PackedSearchNode
+        Returns the heuristic of the node, see the heuristic parameter of the class
+        """
+        if self.heuristic == 'manhattan':
+            return flat_greedy_heur(node.boxes, self.storage_cells, self.hor_tiles)
+        if self.heuristic == 'matching':
+            return self.matching_heuristic(node)
+        #boxes never stand on a deadsquare, so every box has a closest goal
+        closest_goal = self.closest_goal
+        parent = node.parent
+        if parent is not None:
+            #each box adds its own term to the sum and a push only moves one box,
+            #so only the term of the pushed box changes from the parent
+            box = node.pos
+            if not parent.boxes >> box & 1:
+                #a macro, the box started further away than the keeper
+                box = (parent.boxes & ~node.boxes).bit_length() - 1
+            return parent.heuristic - closest_goal[box] + closest_goal[node.pos + node.directions]
+        return sum(closest_goal[box] for box in unpack_cells(node.boxes))
+
+    def matching_heuristic(self, node):
+        """
+        @param node: a node object of the class PackedSearchNode
+        Returns the cost of the minimum cost matching of each box to a different goal, by push distance,
+        or infinity if there isn't a matching where every box can reach its goal (a bipartite deadlock).
+        Results are memoized in a bounded LRU since the same boxes are reached from many states
+        """
+        cache = self.matching_cache
+        key = self.state_key(node.hash, node.boxes)
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+
+        boxes = unpack_cells(node.boxes)
+        goal_distances = self.goal_distances
+        #an edge that doesn't exist costs more than any matching made only of existing edges
+        no_edge = len(self.walls) * len(boxes) + 1
+        costs = [[no_edge if table[box] is None else table[box] for table in goal_distances] for box in boxes]
+        heuristic = min_cost_matching(costs)
+        if heuristic >= no_edge:
+            heuristic = float("inf")
+
+        cache[key] = heuristic
+        if len(cache) > self.matching_cache_size:
+            cache.popitem(last=False)
+        return heuristic
+
+    def solution_path(self, node):
+        """
+        Same as TreeSearch.solution_path, the path to each push of the solution is rebuilt
+        from the keeper tree of the state it was pushed from, only for the nodes of the solution
+        """
+        return self.replay(self.push_history(node))
+
+    def push_history(self, node):
+        """
+        @param node: a node object of the class PackedSearchNode
+        Returns a list with the (box position, direction) of every push from the root to the node
+        """
+        pushes = []
+        while node.parent is not None:
+            pushes.extend(reversed(self.node_pushes(node)))
+            node = node.parent
+        pushes.reverse()
+        return pushes
+
+    def node_pushes(self, node):
+        """
+        @param node: a node object of the class PackedSearchNode, with a parent
+        Returns a list with the (box position, direction) of the pushes from its parent, more than one for a macro
+        """
+        parent = node.parent
+        if parent.boxes >> node.pos & 1:
+            return [(node.pos, node.directions)]
+        box = (parent.boxes & ~node.boxes).bit_length() - 1
+        return self.macro_pushes[box, node.pos, node.directions]
+
+    def replay(self, pushes):
+        """
+        @param pushes: the (box position, direction) of every push from the root, see push_history
+        Returns the string with all the moves of the keeper to make these pushes
+        """
+        keeper, boxes = self.root.pos, self.root.boxes
+        path = []
+        for pos, offset in pushes:
+            parents, distances = flat_keeper_tree(keeper, self.walls, boxes, self.hor_tiles)
+            path.append(flat_tree_path(parents, pos - offset, self.hor_tiles) + self.push_keys[offset])
+            boxes ^= (1 << pos) ^ (1 << (pos + offset))
+            keeper = pos
+        return "".join(path)
+
+    def find_coral_boxes(self, reach_pos, boxes, hash_boxes, storages, walls, deadsquares):
+        '''
+        Same as TreeSearch.find_coral_boxes, over linear indexes and bitsets.
+        The corrals are labeled from the keeper tree of the node: a region out of reach is only cut off
+        by the boxes around it, so a flood fill from the positions next to each box, over the positions
+        the keeper can't reach, finds every corral with its boxes. Each box is tested as soon as it's found,
+        the first one that can leave its corral stops the search
+        @param reach_pos: the previous positions of the keeper tree, -1 on the positions the keeper can't reach
+        Returns a list of linear indexes of the boxes to push
+        '''
+        box_cells = unpack_cells(boxes)
+        #every position out of reach of the keeper is a wall, a box, outside of the reachable area or part of a
+        #corral, so counting the positions out of reach tells if there's a corral without looking for it
+        if reach_pos.count(-1) == self.unreachable_cells:
+            return box_cells
+
+        hor_tiles = self.hor_tiles
+        zobrist = self.zobrist
+        directions = self.directions
+        boxes_coral = []
+        #whether every box of the corrals is on a goal and there's no empty goal in them
+        solved = True
+        #walls are never part of a corral, starting with them labeled saves a lookup
+        labeled = bytearray(walls)
+        for box_cell in box_cells:
+            for cell in (box_cell - hor_tiles, box_cell - 1, box_cell + hor_tiles, box_cell + 1):
+                if labeled[cell] or reach_pos[cell] >= 0 or boxes >> cell & 1:
+                    continue
+                labeled[cell] = 1
+                stack = [cell]
+                while stack:
+                    pos = stack.pop()
+                    if boxes >> pos & 1:
+                        #a box of the corral, check if it can be pushed to a position the keeper reaches
+                        #(which is never a wall nor a box) without a freeze deadlock
+                        without_box = boxes ^ 1 << pos
+                        for offset, d in directions:
+                            push = pos + offset
+                            if reach_pos[push] >= 0 and deadsquares[push]:
+                                new_push_boxes = without_box | 1 << push
+                                #if this push solves the level or leaves the corral, then this is not a Pi-corral
+                                #and it should return all boxes
+                                if (self.completed(self.state_key(hash_boxes ^ zobrist[pos] ^ zobrist[push], new_push_boxes))
+                                    or not self.freeze_deadlock(push, new_push_boxes, storages, walls, deadsquares)):
+                                    return box_cells
+                        boxes_coral.append(pos)
+                        solved = solved and storages >> pos & 1
+                    elif storages >> pos & 1:
+                        solved = False
+                    for nxt in (pos - hor_tiles, pos - 1, pos + hor_tiles, pos + 1):
+                        #boxes can't be reached either, so they are part of the corral too, this is
+                        #what solves multi-room Pi-corrals
+                        if not labeled[nxt] and reach_pos[nxt] < 0:
+                            labeled[nxt] = 1
+                            stack.append(nxt)
+
+        # atleast one box of the corrals not in a goal or atleast one goal of the corrals doesn't have a box
+        if boxes_coral and not solved:
+            return boxes_coral
+        return box_cells
+
+    def freeze_deadlock(self, pos, boxes, storages, walls, deadsquares):
+        """
+        Same as TreeSearch.freeze_deadlock, over linear indexes and bitsets.
+        The result is memoized by the pushed box and the boxes of the 5x5 window around it, in a bounded LRU
+
+        @param pos: the new possible position of the box after a push
+        @param boxes: bitset of the boxes positions after this possible push
+        @param storages: bitset of the goal positions
+        """
+        cache = self.freeze_cache
+        key = pos, (boxes << self.freeze_padding >> pos) & self.freeze_window
+        frozen = cache.get(key)
+        if frozen is not None:
+            cache.move_to_end(key)
+            if frozen is True or frozen is False:
+                return frozen
+            #the boxes the last search with this window looked at went out of it, that search is also
+            #memoized by every position it looked at (walls, deadsquares and goals never change)
+            region_key = pos, frozen, boxes & frozen
+            if region_key in cache:
+                cache.move_to_end(region_key)
+                return cache[region_key]
+
+        frozen, visited_box = self.detect_freeze(pos, boxes, storages, walls, deadsquares)
+        #the checks only look at the visited boxes and the ones next to them, so when these are all around the
+        #pushed box the result only depends on its window
+        if visited_box <= self.freeze_around[pos]:
+            cache[key] = frozen
+        else:
+            region = 0
+            for box in visited_box:
+                region |= self.freeze_cross[box]
+            cache[key] = region
+            cache[pos, region, boxes & region] = frozen
+        while len(cache) > self.freeze_cache_size:
+            cache.popitem(last=False)
+        return frozen
+
+    def detect_freeze(self, pos, boxes, storages, walls, deadsquares):
+        """
+        Computes freeze_deadlock without the cache
+        Returns the boolean value of freeze_deadlock and the set of boxes it visited
+        """
+        hor_tiles = self.hor_tiles
+
+        def recursive(pos, visited_box):
+            if pos in visited_box:
+                return True
+            visited_box.add(pos)
+            blocked_x = False
+            blocked_y = False
+            if not deadsquares[pos + 1] and not deadsquares[pos - 1]:
+                blocked_x = True
+            elif walls[pos + 1] or walls[pos - 1]:
+                blocked_x = True
+            if not deadsquares[pos + hor_tiles] and not deadsquares[pos - hor_tiles]:
+                blocked_y = True
+            elif walls[pos + hor_tiles] or walls[pos - hor_tiles]:
+                blocked_y = True
+
+            if blocked_x and blocked_y:
+                return True
+
+            if not blocked_y:
+                for offset in (-hor_tiles, hor_tiles):
+                    if boxes >> (pos + offset) & 1:
+                        blocked_y = recursive(pos + offset, visited_box)
+                        if blocked_y:
+                            break
+                if not blocked_y:
+                    return False
+                elif blocked_x:
+                    return True
+            if not blocked_x:
+                for offset in (-1, 1):
+                    if boxes >> (pos + offset) & 1:
+                        blocked_x = recursive(pos + offset, visited_box)
+                        if blocked_x:
+                            break
+
+            return blocked_x
+
+        def frozen(visited_box):
+            if not recursive(pos, visited_box):
+                return False
+            if all(storages >> box & 1 for box in visited_box):
+                for box in list(visited_box):
+                    for offset, d in self.directions:
+                        if boxes >> (box + offset) & 1 and not storages >> (box + offset) & 1:
+                            if not recursive(box + offset, visited_box):
+                                return False
+                return not all(storages >> box & 1 for box in visited_box)
+            return True
+
+        visited_box = set()
+        return frozen(visited_box), visited_box
@@ -0,0 +1,321 @@
+"""Headless Solver Benchmarks."""
+import argparse
+import contextlib
+import csv
+import glob
+import io
+import json
+import resource
+import sys
+import time
+from collections import deque
+from functools import partial
+from multiprocessing import get_context
+
+from mapa import Map
+from consts import Tiles
+from AISokobanSolver import TreeSearch, PackedTreeSearch
+import parallel
+
+SOLVERS = {
+    "tuple": TreeSearch,
+    "packed": PackedTreeSearch,
+    "packed-manhattan": partial(PackedTreeSearch, heuristic="manhattan"),
+    "packed-matching": partial(PackedTreeSearch, heuristic="matching"),
+    "packed-bidirectional": partial(PackedTreeSearch, bidirectional=True),
+    "packed-no-macros": partial(PackedTreeSearch, macros=False),
+}
+
+# columns of the CSV results, in order
+FIELDS = [
+    "level",
+    "solver",
+    "status",
+    "solved",
+    "time",
+    "non_terminals",
+    "generated",
+    "nodes_per_sec",
+    "bytes_per_node",
+    "peak_rss",
+    "moves",
+    "pushes",
+]
+
+DIRECTIONS = {"w": (0, -1), "a": (-1, 0), "s": (0, 1), "d": (1, 0)}
+
+
+def node_size(node):
+    """Approximate bytes held by a node on its own (its parent is not counted)."""
+    if hasattr(node, "__dict__"):
+        attrs = node.__dict__
+        size = sys.getsizeof(node) + sys.getsizeof(attrs)
+    else:
+        attrs = {slot: getattr(node, slot) for slot in node.__slots__ if hasattr(node, slot)}
+        size = sys.getsizeof(node)
+
+    for name, value in attrs.items():
+        if name == "parent":
+            continue
+        size += sys.getsizeof(value)
+        if isinstance(value, (set, frozenset, list, tuple, deque)):
+            size += sum(sys.getsizeof(item) for item in value)
+    return size
+
+
+def search_nodes(solver):
+    """Every node still held by the solver: the open nodes and all their ancestors."""
+    nodes = {}
+    for _, _, node in solver.open_nodes:
+        while node is not None and id(node) not in nodes:
+            nodes[id(node)] = node
+            node = node.parent
+    return nodes.values()
+
+
+def count_pushes(mapa, keys):
+    """Play the keys on the map, same as Game.move.
+
+       Returns the number of pushes, or None if a key is blocked or the level isn't completed.
+    """
+    pushes = 0
+    for key in keys:
+        dx, dy = DIRECTIONS[key]
+        x, y = mapa.keeper
+        npos = x + dx, y + dy
+        if mapa.is_blocked(npos):
+            return None
+        if mapa.get_tile(npos) & Tiles.BOX:
+            bpos = npos[0] + dx, npos[1] + dy
+            if mapa.is_blocked(bpos) or mapa.get_tile(bpos) & Tiles.BOX:
+                return None
+            mapa.set_tile(bpos, Tiles.BOX)
+            mapa.clear_tile(npos)
+            pushes += 1
+        mapa.set_tile(npos, Tiles.MAN)
+        mapa.clear_tile((x, y))
+    return pushes if mapa.completed else None
+
+
+def run_solver(name, level_file, timeout, memory=None, profile=False):
+    """Run one solver on one level, stopping it after timeout seconds or memory megabytes.
+
+       With profile, the result also has the SearchStats of the search.
+    """
+    if memory is not None:
+        limit = int(memory * 1024 * 1024)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+    solver = SOLVERS[name](Map(level_file), level_file, profile=profile)
+
+    status = "solved"
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            path = solver.search(timeout)
+        except MemoryError:
+            # drop the search tree to get the memory back for the results
+            solver.open_nodes = []
+            path = None
+            status = "memory"
+    elapsed = time.perf_counter() - start
+
+    pushes = None
+    if path is not None:
+        pushes = count_pushes(Map(level_file), path)
+        if pushes is None:
+            status = "invalid"
+    elif status == "solved":
+        status = "timeout" if elapsed >= timeout else "unsolvable"
+
+    nodes = list(search_nodes(solver))
+    result = {
+        "level": level_file,
+        "solver": name,
+        "status": status,
+        "solved": status == "solved",
+        "time": elapsed,
+        "non_terminals": solver.non_terminals,
+        "generated": solver.generated,
+        "nodes_per_sec": solver.non_terminals / elapsed if elapsed else 0,
+        "bytes_per_node": sum(map(node_size, nodes)) / len(nodes) if nodes else 0,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "moves": len(path) if path is not None else None,
+        "pushes": pushes,
+    }
+    if profile:
+        result["profile"] = solver.stats.as_dict()
+    return result
+
+
+def run_all(solvers, levels, timeout, memory=None, processes=1, profile=False):
+    """Run every solver on every level, spread over a number of processes.
+
+       Each run gets a fresh process, so its peak RSS and memory budget are its own.
+    """
+    runs = [(name, level, timeout, memory, profile) for level in levels for name in solvers]
+    with get_context("spawn").Pool(processes, maxtasksperchild=1) as pool:
+        return pool.starmap(run_solver, runs, chunksize=1)
+
+
+def run_parallel(level_file, workers, timeout):
+    """Run the parallel search with a number of workers on one level."""
+    map_text = str(Map(level_file))
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        path = parallel.solve(map_text, level_file, workers, timeout=timeout)
+    return {
+        "level": level_file,
+        "workers": workers,
+        "solved": path is not None,
+        "time": time.perf_counter() - start,
+    }
+
+
+def print_scaling(results):
+    """Print the parallel search results as a table, with the speedup over its first worker count."""
+    print(f"{'level':<20} {'workers':>7} {'solved':<7} {'time':>8} {'speedup':>8}")
+    baseline = {}
+    for r in results:
+        baseline.setdefault(r["level"], r["time"])
+        print(
+            f"{r['level']:<20} {r['workers']:>7} {str(r['solved']):<7} {r['time']:>8.2f} "
+            f"{baseline[r['level']] / r['time']:>8.2f}"
+        )
+
+
+def print_profile(result):
+    """Print the time of each phase of a profiled run and its pruned children."""
+    stats = result["profile"]
+    print(f"\n{result['level']} {result['solver']}: {stats['expanded']} expanded in {stats['elapsed']:.2f}s")
+    for name, phase in stats["phases"].items():
+        share = phase["seconds"] / stats["elapsed"] * 100 if stats["elapsed"] else 0
+        print(f"  {name:<18} {phase['calls']:>9} calls {phase['seconds']:>8.2f}s {share:>5.1f}%")
+    print("  pruned", " ".join(f"{name}={count}" for name, count in stats["pruned"].items()))
+
+
+def print_results(results):
+    """Print results as a table."""
+    print(
+        f"{'level':<20} {'solver':<16} {'status':<10} {'time':>8} {'expanded':>9} {'generated':>9} "
+        f"{'nodes/s':>9} {'bytes/node':>11} {'peak MB':>8} {'moves':>6} {'pushes':>6}"
+    )
+    for r in results:
+        print(
+            f"{r['level']:<20} {r['solver']:<16} {r['status']:<10} {r['time']:>8.2f} "
+            f"{r['non_terminals']:>9} {r['generated']:>9} {r['nodes_per_sec']:>9.0f} "
+            f"{r['bytes_per_node']:>11.0f} {r['peak_rss']:>8.1f} {str(r['moves']):>6} {str(r['pushes']):>6}"
+        )
+
+    print()
+    print(f"{'solver':<18} {'solved':>7} {'time':>8} {'expanded':>9}")
+    for name in dict.fromkeys(r["solver"] for r in results):
+        runs = [r for r in results if r["solver"] == name]
+        print(
+            f"{name:<18} {sum(r['solved'] for r in runs):>7} {sum(r['time'] for r in runs):>8.2f} "
+            f"{sum(r['non_terminals'] for r in runs):>9}"
+        )
+
+
+def print_speedups(results):
+    """Print the speedup of each solver over the first one on every level both solved."""
+    solvers = list(dict.fromkeys(r["solver"] for r in results))
+    times = {(r["level"], r["solver"]): r["time"] for r in results if r["solved"]}
+    print()
+    print(f"{'level':<20} " + " ".join(f"{name:>20}" for name in solvers[1:]))
+    for level in dict.fromkeys(r["level"] for r in results):
+        baseline = times.get((level, solvers[0]))
+        speedups = []
+        for name in solvers[1:]:
+            run = times.get((level, name))
+            speedups.append(f"{baseline / run:>20.2f}" if baseline and run else f"{'-':>20}")
+        print(f"{level:<20} " + " ".join(speedups))
+
+
+def save_results(results, json_file=None, csv_file=None):
+    """Write the results to a JSON and/or a CSV file."""
+    if json_file:
+        with open(json_file, "w") as outfile:
+            json.dump(results, outfile, indent=1)
+    if csv_file:
+        with open(csv_file, "w", newline="") as outfile:
+            writer = csv.DictWriter(outfile, fieldnames=FIELDS, extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(results)
+
+
+def compare_results(old_file, new_file, threshold, min_delta):
+    """Compare two JSON result files, flagging the runs that got slower or stopped solving.
+
+       A run is slower when its time grew over threshold times and by more than min_delta
+       seconds, so the short runs don't flag on noise. Returns the number of regressions.
+    """
+    with open(old_file) as infile:
+        old = {(r["level"], r["solver"]): r for r in json.load(infile)}
+    with open(new_file) as infile:
+        new = {(r["level"], r["solver"]): r for r in json.load(infile)}
+
+    regressions = 0
+    print(f"{'level':<20} {'solver':<16} {'old':>8} {'new':>8} {'ratio':>6}  flag")
+    for key in sorted(old.keys() & new.keys()):
+        before, after = old[key], new[key]
+        ratio = after["time"] / before["time"] if before["time"] else float("inf")
+        flag = ""
+        if before["solved"] and not after["solved"]:
+            flag = f"NOT SOLVED ({after['status']})"
+            regressions += 1
+        elif after["time"] > before["time"] * threshold and after["time"] - before["time"] > min_delta:
+            flag = "SLOWER"
+            regressions += 1
+        elif after["solved"] and not before["solved"]:
+            flag = "now solved"
+        print(f"{key[0]:<20} {key[1]:<16} {before['time']:>8.2f} {after['time']:>8.2f} {ratio:>6.2f}  {flag}")
+
+    print(f"\n{regressions} regressions")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "levels", nargs="*", default=sorted(glob.glob("levels/*.xsb")), help="level files, all of them by default"
+    )
+    parser.add_argument("--timeout", help="seconds per level and solver", type=float, default=60)
+    parser.add_argument("--memory", help="megabytes per level and solver", type=float)
+    parser.add_argument("--processes", help="runs at the same time", type=int, default=1)
+    parser.add_argument(
+        "--solvers", nargs="+", choices=list(SOLVERS), default=["packed"], help="solvers to run"
+    )
+    parser.add_argument("--profile", help="time each phase of the search", action="store_true")
+    parser.add_argument("--json", help="write the results to this JSON file")
+    parser.add_argument("--csv", help="write the results to this CSV file")
+    parser.add_argument(
+        "--compare", nargs=2, metavar=("OLD", "NEW"), help="flag the regressions between two JSON result files"
+    )
+    parser.add_argument("--threshold", help="time ratio flagged as slower by --compare", type=float, default=1.2)
+    parser.add_argument(
+        "--min-delta", help="seconds a run must slow down by to be flagged", type=float, default=0.1
+    )
+    parser.add_argument(
+        "--workers", nargs="+", type=int, help="benchmark the parallel search scaling with these worker counts"
+    )
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare_results(*args.compare, args.threshold, args.min_delta) else 0)
+
+    if args.workers:
+        print_scaling(
+            [run_parallel(level, workers, args.timeout) for level in args.levels for workers in args.workers]
+        )
+        sys.exit()
+
+    results = run_all(args.solvers, args.levels, args.timeout, args.memory, args.processes, args.profile)
+    print_results(results)
+    if len(args.solvers) > 1:
+        print_speedups(results)
+    if args.profile:
+        for result in results:
+            print_profile(result)
+    save_results(results, args.json, args.csv)
@@ -0,0 +1,150 @@
+"""Offline miner of small deadlock patterns."""
+import argparse
+import hashlib
+import heapq
+import logging
+import time
+from itertools import combinations, count
+
+from mapa import Map
+from AISokobanSolver import PackedTreeSearch
+from searchFunctions import (deadlock_pattern_keys, flat_pattern_deadlock, flat_reachable_positions,
+                             save_deadlock_patterns, unpack_cells)
+
+logger = logging.getLogger("Deadlocks")
+logger.setLevel(logging.INFO)
+
+
+class PatternMiner:
+    """
+    Enumerates every group of 2 to max_boxes boxes of a level, each box next to (or diagonal to) another,
+    on the positions a box can stand on, and proves which groups can never all be pushed to goals.
+    Without the other boxes the level can only be easier, so a group that can't be solved on its own is a
+    deadlock on every state that has it, wherever the keeper is.
+
+    @param solver: a PackedTreeSearch of the level, for its static analysis and zobrist keys
+    @param limit: states a group is searched for before it's given up as not a deadlock
+    """
+    def __init__(self, solver, max_boxes=4, limit=2000):
+        self.solver = solver
+        self.max_boxes = max_boxes
+        self.limit = limit
+        #deadlock patterns found so far, with the zobrist hashes of each one and of the groups inside them
+        self.patterns = []
+        self.keys = set()
+        self.subkeys = set()
+
+        hor_tiles = solver.hor_tiles
+        walls = solver.walls
+        #positions a box can be on: the ones the keeper reaches that aren't deadsquares
+        self.cells = [pos for pos in range(len(walls)) if solver.reachable_area[pos] and solver.deadsquares[pos]]
+        self.neighbours = solver.pattern_neighbours
+
+    def groups(self):
+        """
+        Yields every group of the boxes positions, as a tuple of positions, from the smallest to the largest
+        """
+        cells = set(self.cells)
+        groups = {(pos,) for pos in self.cells}
+        for size in range(2, self.max_boxes + 1):
+            groups = {tuple(sorted(group + (nxt,))) for group in groups for cell in group
+                      for nxt in self.neighbours[cell] if nxt in cells and nxt not in group}
+            yield from sorted(groups)
+
+    def contains_pattern(self, group):
+        """
+        Returns a boolean value, True if a smaller group inside this one is already a deadlock
+        """
+        zobrist = self.solver.zobrist
+        for size in range(2, len(group)):
+            for subgroup in combinations(group, size):
+                key = 0
+                for pos in subgroup:
+                    key ^= zobrist[pos]
+                if key in self.keys:
+                    return True
+        return False
+
+    def solvable(self, boxes):
+        """
+        @param boxes: bitset of the boxes of a group
+        Searches the pushes of these boxes alone, from every region the keeper can start on, until they are
+        all on goals. Pushes into deadsquares or into the patterns already found are pruned
+        Returns True if they can be solved, False if they can't or None if it gave up after limit states
+        """
+        solver = self.solver
+        walls, deadsquares, hor_tiles = solver.walls, solver.deadsquares, solver.hor_tiles
+        storages, closest_goal, zobrist = solver.storages, solver.closest_goal, solver.zobrist
+        directions = solver.directions
+        counter = count()
+
+        #a keeper on each region of the level the boxes split
+        open_states = []
+        for pos in self.cells:
+            if not boxes >> pos & 1:
+                heapq.heappush(open_states, (0, next(counter), boxes, pos))
+
+        visited = set()
+        while open_states:
+            _, _, boxes, keeper = heapq.heappop(open_states)
+            reach = flat_reachable_positions(keeper, walls, boxes, hor_tiles)
+            state = boxes, reach.find(1)
+            if state in visited:
+                continue
+            visited.add(state)
+            if boxes & storages == boxes:
+                return True
+            if len(visited) > self.limit:
+                return None
+
+            for box in unpack_cells(boxes):
+                for offset, d in directions:
+                    dest = box + offset
+                    if (reach[box - offset] and not walls[dest] and not boxes >> dest & 1 and deadsquares[dest]):
+                        pushed = boxes ^ (1 << box) ^ (1 << dest)
+                        if flat_pattern_deadlock(dest, pushed, self.keys, self.subkeys, self.neighbours, zobrist):
+                            continue
+                        heuristic = sum(closest_goal[cell] for cell in unpack_cells(pushed))
+                        heapq.heappush(open_states, (heuristic, next(counter), pushed, box))
+        return False
+
+    def mine(self):
+        """
+        Proves every group, the smallest first, so the bigger ones that contain a deadlock are skipped
+        Returns the list of deadlock patterns, each one a tuple with the positions of its boxes
+        """
+        for group in self.groups():
+            if self.contains_pattern(group):
+                continue
+            boxes = 0
+            for pos in group:
+                boxes |= 1 << pos
+            if self.solvable(boxes) is False:
+                self.patterns.append(group)
+                keys, subkeys = deadlock_pattern_keys([group], self.neighbours, self.solver.zobrist)
+                self.keys |= keys
+                self.subkeys |= subkeys
+        return self.patterns
+
+
+def mine_level(level_file, max_boxes, limit):
+    """Mines the deadlock patterns of a level and stores them, see searchFunctions.load_deadlock_patterns."""
+    mapa = Map(level_file)
+    start = time.perf_counter()
+    miner = PatternMiner(PackedTreeSearch(mapa, level_file), max_boxes, limit)
+    patterns = miner.mine()
+    save_deadlock_patterns(hashlib.sha1(str(mapa).encode()).hexdigest(), patterns)
+    logger.info("%s: %s patterns in %.2fs", level_file, len(patterns), time.perf_counter() - start)
+    return patterns
+
+
+if __name__ == "__main__":
+    logging.basicConfig()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("levels", nargs="+", help="level files")
+    parser.add_argument("--boxes", help="largest pattern", type=int, default=4)
+    parser.add_argument("--limit", help="states searched before a group is given up", type=int, default=2000)
+    args = parser.parse_args()
+
+    for level in args.levels:
+        mine_level(level, args.boxes, args.limit)
@@ -2,6 +2,7 @@
 import asyncio
 import json
 import logging
+from collections import deque
 
 from mapa import Map, Tiles
 from consts import GameStatus
@@ -12,6 +13,8 @@ logger.setLevel(logging.DEBUG)
 INITIAL_SCORE = 0
 TIMEOUT = 3000
 GAME_SPEED = 10
+# a frame that starts later than this fraction of a frame after its time has slipped
+FRAME_SLIP = 0.1
 
 
 def reduce_score(puzzles, moves, pushes, steps, box_on_goal):
@@ -22,7 +25,7 @@ def reduce_score(puzzles, moves, pushes, steps, box_on_goal):
 class Game:
     """Representation of a Game run."""
 
-    def __init__(self, level=1, timeout=TIMEOUT, player=None):
+    def __init__(self, level=1, timeout=TIMEOUT, player=None, headless=False):
         logger.info("Game(level=%s)", level)
         self.puzzles = 0 #puzzles completed
         self.level = level
@@ -40,6 +43,20 @@ class Game:
         self._pushes = 0
         self.map = None
         self._lastkeypress = ""
+        # keys sent by the player to be pressed one per frame, when it doesn't press another one
+        self._plan = deque()
+        # (old position, new position) of the boxes pushed on this frame
+        self._box_moves = []
+        # whether the next state has every box, instead of the boxes pushed since the last one
+        self._snapshot = True
+        # headless games don't wait for the frame clock, a frame goes as soon as the player answers
+        self._headless = headless
+        self._keypressed = asyncio.Event()
+        self._frames = 0
+        # every game keeps its own frame clock: the time of the next frame and the frames that started late
+        self._next_frame = None
+        self._slipped_frames = 0
+        self._max_lag = 0.0
 
         self.next_level(self.level)
 
@@ -78,7 +95,10 @@ class Game:
         self._total_steps += self._step
         self._step = 0
         self._lastkeypress = ""
+        self._plan.clear()
         self._papertrail += "," 
+        self._box_moves = []
+        self._snapshot = True
         self.level = level
         try:
             self.map = Map(f"levels/{level}.xsb")
@@ -88,9 +108,30 @@ class Game:
             self.stop()
             return
 
+    @property
+    def frames(self):
+        """Number of frames calculated so far."""
+        return self._frames
+
+    @property
+    def slipped_frames(self):
+        """Number of frames that started late, see FRAME_SLIP."""
+        return self._slipped_frames
+
+    @property
+    def max_lag(self):
+        """Longest delay of a frame after its time, in seconds."""
+        return self._max_lag
+
     def keypress(self, key):
         """Update locally last key pressed."""
         self._lastkeypress = key
+        self._keypressed.set()
+
+    def plan(self, keys):
+        """Replace the keys to press on the next frames of this level, one per frame."""
+        self._plan = deque(keys)
+        self._keypressed.set()
 
     def move(self, cur, direction):
         """Move an entity in the game."""
@@ -129,10 +170,14 @@ class Game:
         # actually update map
         self.map.set_tile(npos, ctile)
         self.map.clear_tile(cur)
+        if ctile & Tiles.BOX:
+            self._box_moves.append((cur, npos))
         return True
 
     def update_keeper(self):
         """Update the location of the Keeper."""
+        if self._lastkeypress == "" and self._plan:
+            self._lastkeypress = self._plan.popleft()
         if self._lastkeypress == "":
             return GameStatus.NO_OPERATION
         try:
@@ -155,13 +200,41 @@ class Game:
 
     async def next_frame(self):
         """Calculate next frame."""
-        await asyncio.sleep(1.0 / GAME_SPEED)
+        if self._headless:
+            # the player has at most the time of a frame to answer, same as with the frame clock,
+            # it doesn't need to while it has a plan
+            if not self._plan:
+                try:
+                    await asyncio.wait_for(self._keypressed.wait(), 1.0 / GAME_SPEED)
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                # the other sessions and the clients still get their turn on every frame of a plan
+                await asyncio.sleep(0)
+            self._keypressed.clear()
+        else:
+            # sleep until the time of the frame, so the time spent on a frame doesn't delay the next ones
+            loop = asyncio.get_running_loop()
+            if self._next_frame is None:
+                self._next_frame = loop.time()
+            self._next_frame += 1.0 / GAME_SPEED
+            await asyncio.sleep(max(self._next_frame - loop.time(), 0))
+
+            lag = loop.time() - self._next_frame
+            self._max_lag = max(self._max_lag, lag)
+            if lag > FRAME_SLIP / GAME_SPEED:
+                self._slipped_frames += 1
+            if lag > 1.0 / GAME_SPEED:
+                # too far behind to catch up, the clock starts over instead of rushing the next frames
+                self._next_frame = loop.time()
 
         if not self._running:
             logger.info("Waiting for player 1")
             return
 
         self._step += 1
+        self._frames += 1
+        self._box_moves = []
         if self._step >= self._timeout:
             self.stop()
 
@@ -176,13 +249,25 @@ class Game:
             "step": self._step,
             "score": self.score,
             "keeper": self.map.keeper,
-            "boxes": self.map.boxes,
         }
+        # the boxes of a new level are sent in full, then only the ones pushed on each frame
+        if self._snapshot:
+            self._state["boxes"] = self.map.boxes
+            self._snapshot = False
+        elif self._box_moves:
+            self._state["moved"] = self._box_moves
 
         return game_status
 
     @property
     def state(self):
-        """Contains the state of the Game."""
+        """Contains the changes of the state of the Game on the last frame."""
         # logger.debug(self._state)
-        return json.dumps(self._state)
\ No newline at end of file
+        return json.dumps(self._state)
+
+    @property
+    def snapshot(self):
+        """Contains the whole state of the Game, for a client that joins in the middle of it."""
+        state = {key: value for key, value in self._state.items() if key != "moved"}
+        state["boxes"] = self.map.boxes
+        return json.dumps(state)
\ No newline at end of file
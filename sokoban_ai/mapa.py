@@ -1,7 +1,5 @@
 """Generic representation of the Game Map."""
 import logging
-from functools import reduce
-from operator import add
 
 from consts import Tiles, TILES
 
@@ -18,14 +16,28 @@ class Map:
         self._keeper = None
 
         with open(filename, "r") as f:
-            for line in f:
-                codedline = []
-                for c in line.rstrip():
-                    assert c in TILES, f"Invalid character '{c}' in map file"
-                    tile = TILES[c]
-                    codedline.append(tile)
-
-                self._map.append(codedline)
+            self._load(f)
+
+    @classmethod
+    def from_string(cls, text, level=None):
+        """Create a Map from the contents of a level file."""
+        mapa = cls.__new__(cls)
+        mapa._map = []
+        mapa._level = level
+        mapa._keeper = None
+        mapa._load(text.splitlines())
+        return mapa
+
+    def _load(self, lines):
+        """Decode the lines of a level into tiles."""
+        for line in lines:
+            codedline = []
+            for c in line.rstrip():
+                assert c in TILES, f"Invalid character '{c}' in map file"
+                tile = TILES[c]
+                codedline.append(tile)
+
+            self._map.append(codedline)
 
         self.hor_tiles, self.ver_tiles = (
             max([len(line) for line in self._map]),
@@ -37,6 +49,15 @@ class Map:
             while len(line) < self.hor_tiles:
                 self._map[y].append(Tiles.FLOOR)
 
+        self._track()
+
+    def _track(self):
+        """Find the boxes and the empty goals, kept up to date by set_tile and clear_tile from now on."""
+        # dicts keep the order the positions were found in, a row at a time
+        self._boxes = dict.fromkeys(self.filter_tiles([Tiles.BOX, Tiles.BOX_ON_GOAL]))
+        self._empty_goals = dict.fromkeys(self.filter_tiles([Tiles.GOAL, Tiles.MAN_ON_GOAL]))
+        self._on_goal = len(self.filter_tiles([Tiles.BOX_ON_GOAL]))
+
     def __str__(self):
         map_str = ""
         screen = {tile: symbol for symbol, tile in TILES.items()}
@@ -57,6 +78,7 @@ class Map:
             max([len(line) for line in self._map]),
             len(self._map),
         )  # X, Y
+        self._track()
 
     @property
     def size(self):
@@ -66,21 +88,12 @@ class Map:
     @property
     def completed(self):
         """Map is completed when there are no empty_goals!"""
-        return self.empty_goals == []
+        return not self._empty_goals
 
     @property
     def on_goal(self):
-        """Number of boxes on goal.
-
-           Counts per line and counts all lines using reduce
-        """
-        return reduce(
-            add,
-            [
-                reduce(lambda a, b: a + int(b is Tiles.BOX_ON_GOAL), l, 0)
-                for l in self._map
-            ],
-        )
+        """Number of boxes on goal."""
+        return self._on_goal
 
     def filter_tiles(self, list_to_filter):
         """Util to retrieve list of coordinates of given tiles."""
@@ -102,12 +115,12 @@ class Map:
     @property
     def boxes(self):
         """List of coordinates of the boxes."""
-        return self.filter_tiles([Tiles.BOX, Tiles.BOX_ON_GOAL])
+        return list(self._boxes)
 
     @property
     def empty_goals(self):
         """List of coordinates of the empty goals locations."""
-        return self.filter_tiles([Tiles.GOAL, Tiles.MAN_ON_GOAL])
+        return list(self._empty_goals)
 
     def get_tile(self, pos):
         """Retrieve tile at position pos."""
@@ -117,9 +130,11 @@ class Map:
     def set_tile(self, pos, tile):
         """Set the tile at position pos to tile."""
         x, y = pos
+        old = self._map[y][x]
         self._map[y][x] = (
             tile & 0b1110 | self._map[y][x]
         )  # the 0b1110 mask avoid carring ON_GOAL to new tiles
+        self._update(pos, old, self._map[y][x])
 
         if (
             tile & Tiles.MAN == Tiles.MAN
@@ -129,7 +144,24 @@ class Map:
     def clear_tile(self, pos):
         """Remove mobile entity from pos."""
         x, y = pos
+        old = self._map[y][x]
         self._map[y][x] = self._map[y][x] & 0b1  # lesser bit carries ON_GOAL
+        self._update(pos, old, self._map[y][x])
+
+    def _update(self, pos, old, new):
+        """Keep the boxes and the empty goals up to date after the tile at pos changed from old to new."""
+        if not (old ^ new) & Tiles.BOX:
+            return
+        if new & Tiles.BOX:
+            self._boxes[pos] = None
+            if new & Tiles.GOAL:
+                self._on_goal += 1
+                del self._empty_goals[pos]
+        else:
+            del self._boxes[pos]
+            if new & Tiles.GOAL:
+                self._on_goal -= 1
+                self._empty_goals[pos] = None
 
     def is_blocked(self, pos):
         """Determine if mobile entity can be placed at pos."""
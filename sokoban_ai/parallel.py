@@ -0,0 +1,188 @@
+"""Parallel best-first search, with the states sharded across worker processes."""
+import heapq
+import logging
+import multiprocessing
+import queue
+import time
+
+from mapa import Map
+from AISokobanSolver import PackedSearchNode, PackedTreeSearch
+
+logger = logging.getLogger("Parallel")
+logger.setLevel(logging.INFO)
+
+# workers are forked, same as the portfolio
+CONTEXT = multiprocessing.get_context("fork")
+
+
+class ShardedTreeSearch(PackedTreeSearch):
+    """
+    PackedTreeSearch that owns a single shard of the states, the ones whose box hash modulo
+    the number of workers is its index. Each worker keeps the open nodes and the visited states
+    (the transposition table) of its shard, the children owned by another worker are sent to it,
+    so duplicates are always detected by the owner of the state.
+    A received node has no parent on this process, the pushes that lead to it travel with it
+    """
+    def __init__(self, mapa, level, index, workers, **kwargs):
+        self.index = index
+        self.workers = workers
+        #children owned by each worker, waiting to be sent
+        self.outbox = [[] for _ in range(workers)]
+        #pushes from the root to each received node
+        self.received = {}
+        super().__init__(mapa, level, **kwargs)
+        if self.root.hash % workers != index:
+            self.open_nodes = []
+
+    def check_backtrack(self, node, key):
+        """
+        Same as TreeSearch.check_backtrack for the states of this shard, the other states
+        go to the outbox of their owner and are not added to the open nodes here
+        """
+        owner = node.hash % self.workers
+        if owner != self.index:
+            self.outbox[owner].append(node)
+            return False
+        return super().check_backtrack(node, key)
+
+    def push_history(self, node):
+        """
+        Same as PackedTreeSearch.push_history, going on with the pushes received with the first node
+        """
+        pushes = []
+        while node.parent is not None:
+            pushes.extend(reversed(self.node_pushes(node)))
+            node = node.parent
+        if node in self.received:
+            pushes.extend(reversed(self.received[node]))
+        pushes.reverse()
+        return pushes
+
+    def send(self, inboxes):
+        """
+        Sends the outbox of each worker to its inbox, in a single message per worker
+        Returns the number of nodes sent
+        """
+        sent = 0
+        for owner, nodes in enumerate(self.outbox):
+            if nodes:
+                inboxes[owner].put([
+                    (node.pos, node.directions, node.boxes, node.hash, node.cost, node.depth,
+                     self.push_history(node))
+                    for node in nodes
+                ])
+                sent += len(nodes)
+                nodes.clear()
+        return sent
+
+    def receive(self, states):
+        """
+        @param states: the nodes sent by another worker
+        Does the checks get_pushes skipped for them (visited states, freeze deadlocks, deadlock
+        patterns and the heuristic) and adds the ones that pass to the open nodes
+        Returns the number of nodes discarded
+        """
+        kept = []
+        for pos, directions, boxes, hash_boxes, cost, depth, history in states:
+            node = PackedSearchNode(pos, None, directions)
+            node.boxes = boxes
+            node.hash = hash_boxes
+            node.cost = cost
+            node.depth = depth
+            dest = pos + directions
+            if (self.check_backtrack(node, self.state_key(hash_boxes, boxes))
+                and not self.freeze_deadlock(dest, boxes, self.storages, self.walls, self.deadsquares)
+                and not (self.deadlock_patterns and self.pattern_deadlock(dest, boxes))):
+                node.heuristic = self.node_heuristic(node)
+                if node.heuristic != float("inf"):
+                    self.received[node] = history
+                    kept.append(node)
+        self.add_to_open(kept, self.open_nodes)
+        return len(states) - len(kept)
+
+    def search_shard(self, inboxes, results, pending, timeout=None):
+        """
+        Expands the open nodes of this shard, sending and receiving the nodes of other shards.
+        pending counts the open nodes of every worker plus the ones being sent, once it gets
+        to 0 there's nothing left to expand anywhere
+        Puts the keys that solve the level on results, or None if there's no solution
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        inbox = inboxes[self.index]
+        while deadline is None or time.monotonic() < deadline:
+            try:
+                while True:
+                    discarded = self.receive(inbox.get_nowait())
+                    if discarded:
+                        with pending.get_lock():
+                            pending.value -= discarded
+            except queue.Empty:
+                pass
+
+            if not self.open_nodes:
+                if pending.value == 0:
+                    results.put(None)
+                    return
+                try:
+                    discarded = self.receive(inbox.get(timeout=0.01))
+                    if discarded:
+                        with pending.get_lock():
+                            pending.value -= discarded
+                except queue.Empty:
+                    pass
+                continue
+
+            node = heapq.heappop(self.open_nodes)[2]
+            self.non_terminals += 1
+            self.update_strategy()
+            poss_pushes, completed = self.get_pushes(node)
+            if completed:
+                results.put(self.solution_path(poss_pushes[0]))
+                return
+            self.add_to_open(poss_pushes, self.open_nodes)
+            #the children are counted before the expanded node is discounted
+            with pending.get_lock():
+                pending.value += len(poss_pushes) + self.send(inboxes) - 1
+        results.put(None)
+
+
+def search_worker(index, workers, level, map_text, config, inboxes, results, pending, timeout):
+    """Search one shard of the states of a level."""
+    mapa = Map.from_string(map_text, level)
+    solver = ShardedTreeSearch(mapa, level, index, workers, **config)
+    solver.search_shard(inboxes, results, pending, timeout)
+
+
+def solve(map_text, level, workers, config=None, timeout=None):
+    """Search the level with a shard of the states on each one of workers processes.
+
+       config has the keyword arguments of PackedTreeSearch, each worker changes its
+       strategy by the nodes it expanded.
+       Returns the keys that solve the level, or None if it has no solution or time ran out.
+    """
+    config = {} if config is None else config
+    inboxes = [CONTEXT.Queue() for _ in range(workers)]
+    results = CONTEXT.Queue()
+    # the root is the only pending node
+    pending = CONTEXT.Value("q", 1)
+    processes = [
+        CONTEXT.Process(
+            target=search_worker,
+            args=(index, workers, level, map_text, config, inboxes, results, pending, timeout),
+            daemon=True,
+        )
+        for index in range(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    try:
+        return results.get(timeout=timeout)
+    except queue.Empty:
+        logger.info("No solution for %s in %s seconds", level, timeout)
+        return None
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
@@ -0,0 +1,96 @@
+"""Portfolio of solver configurations raced on parallel processes."""
+import asyncio
+import logging
+import multiprocessing
+import queue
+import time
+
+from mapa import Map
+from AISokobanSolver import PackedTreeSearch
+
+logger = logging.getLogger("Portfolio")
+logger.setLevel(logging.INFO)
+
+# keyword arguments of PackedTreeSearch for each configuration of the portfolio
+PORTFOLIO = {
+    "schedule": {},  # bfs, then a* and greedy as the search grows
+    "greedy": {"strategy": "greedy", "change_strategy": False},
+    "weighted-a*": {"strategy": "a*", "change_strategy": False, "weight": 3},
+    "matching-a*": {"strategy": "a*", "change_strategy": False, "weight": 1, "heuristic": "matching"},
+}
+
+# seconds between checks that the workers are still alive while waiting for a result
+POLL_INTERVAL = 1
+
+# workers are forked: the agent scripts run on import, so they can't be spawned again
+CONTEXT = multiprocessing.get_context("fork")
+
+
+def solve_worker(name, level, map_text, config, results, timeout):
+    """Solve a level with one configuration, putting (name, keys) on the results queue.
+
+       keys is None if it fails, so solve never waits for a worker that already stopped.
+    """
+    keys = None
+    try:
+        mapa = Map.from_string(map_text, level)
+        solver = PackedTreeSearch(mapa, level, **config)
+        keys = solver.search(timeout)
+    finally:
+        results.put((name, keys))
+
+
+def solve(map_text, level, portfolio=PORTFOLIO, timeout=None):
+    """Race every configuration of the portfolio on the level.
+
+       The map goes to each worker once, as the text of the level. Returns the keys of
+       the first configuration to solve it, the other workers are terminated. Returns None
+       if no configuration solves the level within timeout seconds.
+    """
+    results = CONTEXT.Queue()
+    workers = [
+        CONTEXT.Process(
+            target=solve_worker, args=(name, level, map_text, config, results, timeout), daemon=True
+        )
+        for name, config in portfolio.items()
+    ]
+    for worker in workers:
+        worker.start()
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+    pending = len(workers)
+    try:
+        while pending:
+            remaining = POLL_INTERVAL if deadline is None else min(POLL_INTERVAL, deadline - time.monotonic())
+            try:
+                name, keys = results.get(timeout=max(0, remaining))
+            except queue.Empty:
+                if deadline is not None and time.monotonic() >= deadline:
+                    logger.info("No solution for %s in %s seconds", level, timeout)
+                    break
+                # a worker killed by a signal (e.g. out of memory) never puts its result
+                if all(worker.exitcode is not None for worker in workers) and results.empty():
+                    logger.info("Every worker stopped without a solution for %s", level)
+                    break
+                continue
+            pending -= 1
+            if keys is not None:
+                logger.info("<%s> solved %s", name, level)
+                return keys
+            logger.info("<%s> found no solution for %s", name, level)
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
+    return None
+
+
+async def solve_async(map_text, level, portfolio=PORTFOLIO, timeout=None):
+    """Same as solve, as a future of the event loop.
+
+       solve only waits on the workers, on a thread of the default executor, so the
+       event loop keeps serving the network while the level is solved.
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, solve, map_text, level, portfolio, timeout)
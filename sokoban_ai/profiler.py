@@ -0,0 +1,154 @@
+"""Optional instrumentation of the hot path of TreeSearch."""
+import logging
+import time
+
+logger = logging.getLogger("Profiler")
+logger.setLevel(logging.INFO)
+
+# methods of TreeSearch timed by the profiler, the ones a solver doesn't have are skipped.
+# Times are inclusive: check_backtrack also counts the normalized_keeper it calls
+PHASES = [
+    "get_pushes",
+    "keeper_tree",
+    "keeper_path",
+    "find_coral_boxes",
+    "freeze_deadlock",
+    "detect_freeze",
+    "pattern_deadlock",
+    "check_backtrack",
+    "normalized_keeper",
+    "node_heuristic",
+    "add_to_open",
+]
+
+
+class SearchStats:
+    """
+    Cumulative timers and call counts of each phase of a search, the children pruned by
+    each check and the size of the open nodes over time.
+
+    It replaces the methods of a single solver with timed wrappers (see instrument), so a
+    solver without it runs the plain methods and pays nothing.
+    @param sample_every: expanded nodes between two samples of the open nodes
+    @param interval: seconds between two log lines of a running search, None to never log
+    """
+    def __init__(self, sample_every=1000, interval=10):
+        self.sample_every = sample_every
+        self.interval = interval
+        #phase name: [calls, seconds]
+        self.phases = {}
+        #children of get_pushes by the check that pruned them
+        self.pruned = {"duplicate": 0, "freeze": 0, "no_matching": 0, "pattern": 0}
+        #(expanded nodes, seconds, open nodes)
+        self.open_sizes = []
+        self.start = time.perf_counter()
+        #set once search returns
+        self.end = None
+        self.last_emit = self.start
+
+    def instrument(self, solver):
+        """
+        Times every phase of PHASES of the solver and counts its pruned children and open nodes
+        """
+        self.solver = solver
+        for name in PHASES:
+            if hasattr(solver, name):
+                setattr(solver, name, self.timed(name, getattr(solver, name)))
+
+        get_pushes = solver.get_pushes
+        def counted_get_pushes(node):
+            generated, duplicates = solver.generated, solver.duplicates
+            self.rejected = 0
+            pushes, completed = get_pushes(node)
+            if not completed:
+                #every generated child is either kept, a duplicate, frozen or rejected by a counted check
+                duplicate = solver.duplicates - duplicates
+                self.pruned["duplicate"] += duplicate
+                self.pruned["freeze"] += solver.generated - generated - duplicate - len(pushes) - self.rejected
+            return pushes, completed
+        solver.get_pushes = counted_get_pushes
+        #children of the current get_pushes without a matching or in a deadlock pattern
+        self.rejected = 0
+
+        if hasattr(solver, "node_heuristic"):
+            node_heuristic = solver.node_heuristic
+            def counted_node_heuristic(node):
+                heuristic = node_heuristic(node)
+                if heuristic == float("inf"):
+                    self.rejected += 1
+                    self.pruned["no_matching"] += 1
+                return heuristic
+            solver.node_heuristic = counted_node_heuristic
+
+        if hasattr(solver, "pattern_deadlock"):
+            pattern_deadlock = solver.pattern_deadlock
+            def counted_pattern_deadlock(pos, boxes):
+                deadlock = pattern_deadlock(pos, boxes)
+                if deadlock:
+                    self.rejected += 1
+                    self.pruned["pattern"] += 1
+                return deadlock
+            solver.pattern_deadlock = counted_pattern_deadlock
+
+        #called once per expanded node, by search and by the parallel workers
+        update_strategy = solver.update_strategy
+        def sampled_update_strategy():
+            update_strategy()
+            if solver.non_terminals % self.sample_every == 0:
+                self.sample()
+        solver.update_strategy = sampled_update_strategy
+
+        search = solver.search
+        def finished_search(timeout=None):
+            keys = search(timeout)
+            self.end = time.perf_counter()
+            self.sample()
+            return keys
+        solver.search = finished_search
+
+    def timed(self, name, function):
+        """
+        Returns function adding its calls and time to the phase name
+        """
+        phase = self.phases[name] = [0, 0.0]
+        clock = time.perf_counter
+        def wrapper(*args):
+            start = clock()
+            result = function(*args)
+            phase[0] += 1
+            phase[1] += clock() - start
+            return result
+        return wrapper
+
+    def sample(self):
+        """
+        Records the size of the open nodes, logging the stats once every interval seconds
+        """
+        now = time.perf_counter()
+        self.open_sizes.append((self.solver.non_terminals, now - self.start, len(self.solver.open_nodes)))
+        if self.interval is not None and now - self.last_emit >= self.interval:
+            self.last_emit = now
+            logger.info("%s", self.summary())
+
+    def as_dict(self):
+        """
+        The stats as plain values, ready for json
+        """
+        return {
+            "level": self.solver.level,
+            "elapsed": (self.end or time.perf_counter()) - self.start,
+            "expanded": self.solver.non_terminals,
+            "generated": self.solver.generated,
+            "phases": {name: {"calls": calls, "seconds": seconds} for name, (calls, seconds) in self.phases.items()},
+            "pruned": dict(self.pruned),
+            "open_sizes": list(self.open_sizes),
+        }
+
+    def summary(self):
+        """
+        One line with the expanded nodes, the open nodes, the time of each phase and the pruned children
+        """
+        phases = " ".join(f"{name}={seconds:.2f}s/{calls}" for name, (calls, seconds) in self.phases.items())
+        pruned = " ".join(f"{name}={count}" for name, count in self.pruned.items())
+        return (f"{self.solver.level} expanded={self.solver.non_terminals} open={len(self.solver.open_nodes)} "
+                f"{phases} {pruned}")
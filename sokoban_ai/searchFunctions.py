@@ -1,4 +1,9 @@
+from array import array
 from collections import deque
+from itertools import combinations
+import os
+import pickle
+import random
 
 def bfs(start, end, map, boxes):
 	"""
@@ -133,4 +138,526 @@ def greedy_heur(node, storages):
 		assigned_boxes.add(min_box)
 		heur += minimum
 
-	return heur
\ No newline at end of file
+	return heur
+
+def flatten_walls(map):
+	"""
+	@param map: map object that representes the current state
+	Returns a flat bytearray, indexed by y * hor_tiles + x, with a 1 on every wall.
+	The border of the map is also marked, so a flat search never wraps around a row
+	"""
+	hor_tiles, ver_tiles = map.size
+	walls = bytearray(hor_tiles * ver_tiles)
+	for y, line in enumerate(map._map):
+		for x, tile in enumerate(line):
+			if tile & 0b1000 or not (0 < x < hor_tiles - 1 and 0 < y < ver_tiles - 1):
+				walls[y * hor_tiles + x] = 1
+	return walls
+
+def pack_cells(positions, hor_tiles):
+	"""
+	@param positions: an iterable of (x, y) positions
+	@param hor_tiles: width of the map
+	Returns a bitset (int) with one bit set for the linear index of each position
+	"""
+	bits = 0
+	for x, y in positions:
+		bits |= 1 << (y * hor_tiles + x)
+	return bits
+
+def unpack_cells(bits):
+	"""
+	@param bits: a bitset of cells
+	Returns a list with the linear index of every bit set, in ascending order
+	"""
+	cells = []
+	while bits:
+		low = bits & -bits
+		cells.append(low.bit_length() - 1)
+		bits ^= low
+	return cells
+
+def flat_reachable_positions(start, walls, boxes, hor_tiles):
+	"""
+	@param start: the linear index of the starting position
+	@param walls: flat bytearray of walls
+	@param boxes: bitset with the boxes positions
+	Returns a flat bytearray with the visited positions of the CURRENT State, same as reachable_positions
+	"""
+	vis = bytearray(len(walls))
+	queue = deque([start])
+	vis[start] = 1
+
+	while queue:
+		cur = queue.popleft()
+		for nxt in (cur - hor_tiles, cur - 1, cur + hor_tiles, cur + 1):
+			if not vis[nxt] and not walls[nxt] and not boxes >> nxt & 1:
+				vis[nxt] = 1
+				queue.append(nxt)
+
+	return vis
+
+def flat_greedy_heur(boxes, storages, hor_tiles):
+	"""
+	Same as greedy_heur, but for a bitset of boxes
+	@param boxes: bitset with the boxes positions
+	@param storages: list with the linear index of the goal positions
+	"""
+	heur = 0
+	boxes = [divmod(box, hor_tiles) for box in unpack_cells(boxes)]
+	assigned_boxes = set()
+	for storage in storages:
+		sy, sx = divmod(storage, hor_tiles)
+		min_box, minimum = 0, 1000
+		for box in boxes:
+			if box not in assigned_boxes:
+				cost = abs(box[0] - sy) + abs(box[1] - sx)
+				if cost < minimum:
+					min_box, minimum = box, cost
+		assigned_boxes.add(min_box)
+		heur += minimum
+
+	return heur
+
+def zobrist_table(size, seed=None):
+	"""
+	@param size: number of cells of the map
+	@param seed: seed of the random keys, so the same map always gets the same table
+	Returns a list with a random 64-bit key for each cell
+	"""
+	rng = random.Random(seed)
+	return [rng.getrandbits(64) for _ in range(size)]
+
+def zobrist_hash(cells, table):
+	"""
+	@param cells: an iterable with the linear index of each box
+	@param table: the zobrist table of the map
+	Returns the 64-bit hash of the boxes, the XOR of the key of each occupied cell.
+	Moving a box from a to b updates it with hash ^ table[a] ^ table[b]
+	"""
+	hash_boxes = 0
+	for cell in cells:
+		hash_boxes ^= table[cell]
+	return hash_boxes
+
+def flat_keeper_tree(start, walls, boxes, hor_tiles):
+	"""
+	Breadth first search from "start" over the flattened map, that records how each position was reached.
+	A single call gives every path the keeper can walk on the current state
+	@param walls: flat bytearray of walls
+	@param boxes: bitset with the boxes positions
+	Returns two flat lists: the previous position of every position (the start is its own previous position and
+	the positions that can't be reached have -1), and the number of moves to reach every position
+	"""
+	parents = [-1] * len(walls)
+	distances = [0] * len(walls)
+	parents[start] = start
+	queue = deque([start])
+
+	while queue:
+		cur = queue.popleft()
+		distance = distances[cur] + 1
+		for nxt in (cur - hor_tiles, cur - 1, cur + hor_tiles, cur + 1):
+			if parents[nxt] < 0 and not walls[nxt] and not boxes >> nxt & 1:
+				parents[nxt] = cur
+				distances[nxt] = distance
+				queue.append(nxt)
+
+	return parents, distances
+
+def flat_tree_path(parents, end, hor_tiles):
+	"""
+	@param parents: the previous positions returned by flat_keeper_tree
+	@param end: a reachable position
+	Returns a string with the path from the start of the tree to "end", the same path bfs finds
+	"""
+	moves = {-hor_tiles: "w", -1: "a", hor_tiles: "s", 1: "d"}
+	path = []
+	while parents[end] != end:
+		path.append(moves[end - parents[end]])
+		end = parents[end]
+	return "".join(reversed(path))
+
+def push_distances(goal, walls, hor_tiles):
+	"""
+	Reverse push breadth first search, pulling a box away from "goal" in every direction it can be pulled.
+	A box can be pulled from a position to the next one when the keeper has room for it, the next two
+	positions in that direction are not walls. Other boxes are not taken into account.
+	@param goal: the linear index of a goal position
+	@param walls: flat bytearray of walls
+	Returns a flat list with the minimum number of pushes to take a box from each position to "goal",
+	None where the box can never reach it
+	"""
+	distances = [None] * len(walls)
+	distances[goal] = 0
+	queue = deque([goal])
+
+	while queue:
+		cur = queue.popleft()
+		distance = distances[cur] + 1
+		for offset in (-hor_tiles, -1, hor_tiles, 1):
+			prev = cur + offset
+			if distances[prev] is None and not walls[prev] and not walls[prev + offset]:
+				distances[prev] = distance
+				queue.append(prev)
+
+	return distances
+
+def pull_distances(start, walls, hor_tiles):
+	"""
+	Push breadth first search, pushing a box away from "start" in every direction it can be pushed, the
+	opposite of push_distances. Other boxes are not taken into account.
+	@param start: the linear index of the initial position of a box
+	@param walls: flat bytearray of walls
+	Returns a flat list with the minimum number of pulls to take a box from each position back to "start",
+	None where the box can never be pushed to
+	"""
+	distances = [None] * len(walls)
+	distances[start] = 0
+	queue = deque([start])
+
+	while queue:
+		cur = queue.popleft()
+		distance = distances[cur] + 1
+		for offset in (-hor_tiles, -1, hor_tiles, 1):
+			nxt = cur + offset
+			if distances[nxt] is None and not walls[nxt] and not walls[cur - offset]:
+				distances[nxt] = distance
+				queue.append(nxt)
+
+	return distances
+
+def push_distance_tables(walls, goals, hor_tiles):
+	"""
+	@param walls: flat bytearray of walls
+	@param goals: list with the linear index of the goal positions
+	Returns the push_distances of every goal, in the same order as "goals", and a flat list with the
+	distance of each position to its closest goal (None on the positions that can't reach any goal)
+	"""
+	tables = [push_distances(goal, walls, hor_tiles) for goal in goals]
+	closest = [None] * len(walls)
+	for cell in range(len(walls)):
+		reachable = [table[cell] for table in tables if table[cell] is not None]
+		if reachable:
+			closest[cell] = min(reachable)
+	return tables, closest
+
+def flat_deadsquares(walls, goals, hor_tiles):
+	"""
+	Iterative version of TreeSearch.simple_deadlock over the flattened map, a reverse pull pass that pulls
+	a box away from every goal, with the same rule as push_distances
+	@param walls: flat bytearray of walls
+	@param goals: list with the linear index of the goal positions
+	Returns a flat bytearray with a 1 on every position a box can still be pushed to a goal from,
+	the positions left at 0 are simple deadlocks
+	"""
+	vis = bytearray(len(walls))
+	stack = [goal for goal in goals if not walls[goal]]
+	for goal in stack:
+		vis[goal] = 1
+
+	while stack:
+		cur = stack.pop()
+		for offset in (hor_tiles, 1, -hor_tiles, -1):
+			prev = cur + offset
+			if not vis[prev] and not walls[prev] and not walls[prev + offset]:
+				vis[prev] = 1
+				stack.append(prev)
+
+	return vis
+
+def flat_box_pushes(box, target, keeper, walls, boxes, hor_tiles, exit=None):
+	"""
+	Breadth first search of the pushes of a single box, the other boxes stay where they are
+	@param box, target: the linear indexes of the box and of the position to push it to
+	@param keeper: the linear index of the keeper
+	@param boxes: bitset with the other boxes positions
+	@param exit: a position the keeper must still reach once the box is on target, if any
+	Returns a list with the (box position, direction) of the fewest pushes that take the box to target,
+	or None if it can't get there
+	"""
+	reach = flat_reachable_positions(keeper, walls, boxes | 1 << box, hor_tiles)
+	start = box, reach.find(1)
+	parents = {start: None}
+	queue = deque([(box, reach)])
+
+	while queue:
+		box, reach = queue.popleft()
+		state = box, reach.find(1)
+		if box == target and (exit is None or reach[exit]):
+			pushes = []
+			while parents[state] is not None:
+				state, push = parents[state]
+				pushes.append(push)
+			pushes.reverse()
+			return pushes
+		for offset in (-hor_tiles, -1, hor_tiles, 1):
+			dest = box + offset
+			if reach[box - offset] and not walls[dest] and not boxes >> dest & 1:
+				nxt_reach = flat_reachable_positions(box, walls, boxes | 1 << dest, hor_tiles)
+				nxt = dest, nxt_reach.find(1)
+				if nxt not in parents:
+					parents[nxt] = state, (box, offset)
+					queue.append((dest, nxt_reach))
+	return None
+
+def flat_goal_rooms(walls, goals, hor_tiles):
+	"""
+	@param walls: flat bytearray of walls
+	@param goals: list with the linear index of the goal positions
+	Returns a list with the goal rooms of the map, each one a pair of the list of its goals and its entrance.
+	A goal room is a group of goals next to each other that only one position that is not a goal leads to
+	"""
+	goal_cells = set(goals)
+	rooms = []
+	seen = set()
+	for goal in goals:
+		if goal in seen:
+			continue
+		room = [goal]
+		seen.add(goal)
+		for cell in room:
+			for nxt in (cell - hor_tiles, cell - 1, cell + hor_tiles, cell + 1):
+				if nxt in goal_cells and nxt not in seen:
+					seen.add(nxt)
+					room.append(nxt)
+		entrances = {nxt for cell in room for nxt in (cell - hor_tiles, cell - 1, cell + hor_tiles, cell + 1)
+					 if not walls[nxt] and nxt not in goal_cells}
+		if len(entrances) == 1:
+			rooms.append((sorted(room), entrances.pop()))
+	return rooms
+
+def goal_room_macros(room, entrance, offset, walls, hor_tiles, limit=1000):
+	"""
+	Finds an order to fill a goal room with boxes pushed in through its entrance in the direction "offset",
+	so that every box still fits once the previous ones are on their goals and the keeper can always leave.
+	The goals the furthest away from the entrance are tried first
+	@param room, entrance: a goal room, see flat_goal_rooms
+	@param limit: box searches tried before giving up on the room
+	Returns a dict with the pushes of each step of the order: by the bitset of the goals filled before it, the
+	goal of the box, the (box position, direction) of its pushes from the entrance and the moves they take,
+	or None if no order was found
+	"""
+	keeper = entrance - offset
+	if walls[keeper] or entrance + offset not in room:
+		return None
+	#the keeper stays inside of the room, the entrance and the position it pushes the box in from
+	room_walls = bytearray([1]) * len(walls)
+	for cell in room + [entrance, keeper]:
+		room_walls[cell] = 0
+	depth = {entrance: 0}
+	queue = [entrance]
+	for cell in queue:
+		for nxt in (cell - hor_tiles, cell - 1, cell + hor_tiles, cell + 1):
+			if nxt in room and nxt not in depth:
+				depth[nxt] = depth[cell] + 1
+				queue.append(nxt)
+	tries = [limit]
+
+	def fill(filled):
+		empty = [goal for goal in room if not filled >> goal & 1]
+		if not empty:
+			return {}
+		for goal in sorted(empty, key=depth.get, reverse=True):
+			if not tries[0]:
+				return None
+			tries[0] -= 1
+			pushes = flat_box_pushes(entrance, goal, keeper, room_walls, filled, hor_tiles, exit=entrance)
+			if pushes is None:
+				continue
+			steps = fill(filled | 1 << goal)
+			if steps is not None:
+				moves, position, boxes = 0, keeper, filled | 1 << entrance
+				for pos, push in pushes:
+					parents, distances = flat_keeper_tree(position, room_walls, boxes, hor_tiles)
+					moves += distances[pos - push] + 1
+					boxes ^= (1 << pos) ^ (1 << (pos + push))
+					position = pos
+				steps[filled] = goal, tuple(pushes), moves
+				return steps
+		return None
+
+	return fill(0)
+
+#bump it whenever the static analysis changes, so old cache files are not used
+STATIC_ANALYSIS_VERSION = 2
+STATIC_ANALYSIS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".static_analysis")
+#static analysis already loaded or computed by this process, by map content hash
+_static_analysis_cache = {}
+
+def cached_static_analysis(key, analyse):
+	"""
+	@param key: the content hash of a map
+	@param analyse: function that computes the static analysis of that map
+	Returns the static analysis of the map. It is looked up in memory, then on disk, and only when
+	it's on neither is analyse called, storing its result on both
+	"""
+	if key in _static_analysis_cache:
+		return _static_analysis_cache[key]
+
+	filename = os.path.join(STATIC_ANALYSIS_DIR, f"{key}.v{STATIC_ANALYSIS_VERSION}.pickle")
+	try:
+		with open(filename, "rb") as f:
+			analysis = pickle.load(f)
+	except (OSError, pickle.UnpicklingError, EOFError):
+		analysis = analyse()
+		try:
+			os.makedirs(STATIC_ANALYSIS_DIR, exist_ok=True)
+			#write to a temporary file first, so a concurrent reader never sees half a file
+			tmp_filename = f"{filename}.{os.getpid()}.tmp"
+			with open(tmp_filename, "wb") as f:
+				pickle.dump(analysis, f, pickle.HIGHEST_PROTOCOL)
+			os.replace(tmp_filename, filename)
+		except OSError:
+			pass
+
+	_static_analysis_cache[key] = analysis
+	return analysis
+
+DEADLOCK_PATTERNS_VERSION = 1
+DEADLOCK_PATTERNS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".deadlock_patterns")
+
+def deadlock_patterns_file(key):
+	"""
+	@param key: the content hash of a map
+	Returns the name of the file with the deadlock patterns of that map
+	"""
+	return os.path.join(DEADLOCK_PATTERNS_DIR, f"{key}.v{DEADLOCK_PATTERNS_VERSION}.bin")
+
+def save_deadlock_patterns(key, patterns):
+	"""
+	@param key: the content hash of a map
+	@param patterns: the deadlock patterns of that map, each one a tuple with the linear index of its boxes
+	Stores the patterns as an array of 16-bit integers, the number of boxes of each pattern followed by them
+	"""
+	cells = array("H")
+	for pattern in sorted(patterns):
+		cells.append(len(pattern))
+		cells.extend(pattern)
+	os.makedirs(DEADLOCK_PATTERNS_DIR, exist_ok=True)
+	filename = deadlock_patterns_file(key)
+	tmp_filename = f"{filename}.{os.getpid()}.tmp"
+	with open(tmp_filename, "wb") as f:
+		cells.tofile(f)
+	os.replace(tmp_filename, filename)
+
+def load_deadlock_patterns(key):
+	"""
+	@param key: the content hash of a map
+	Returns a list with the deadlock patterns mined for that map, empty if it wasn't mined
+	"""
+	cells = array("H")
+	try:
+		with open(deadlock_patterns_file(key), "rb") as f:
+			cells.frombytes(f.read())
+	except (OSError, ValueError):
+		pass
+	patterns = []
+	i = 0
+	while i < len(cells):
+		patterns.append(tuple(cells[i + 1:i + 1 + cells[i]]))
+		i += 1 + cells[i]
+	return patterns
+
+def deadlock_pattern_keys(patterns, neighbours, zobrist):
+	"""
+	@param patterns: a list of deadlock patterns, see load_deadlock_patterns
+	@param neighbours: list with the 8 positions around each position
+	Returns a set with the zobrist hash of each pattern and a set with the hash of every smaller group of
+	boxes, each next to another, inside a pattern: the only groups worth growing looking for a pattern
+	"""
+	keys = set()
+	subkeys = set()
+	for pattern in patterns:
+		keys.add(zobrist_hash(pattern, zobrist))
+		for size in range(1, len(pattern)):
+			for group in combinations(pattern, size):
+				#a group with a box apart from the others is never grown by flat_pattern_deadlock
+				if size == 1 or all(any(other in neighbours[cell] for other in group) for cell in group):
+					subkeys.add(zobrist_hash(group, zobrist))
+	return keys, subkeys
+
+def flat_pattern_deadlock(pos, boxes, patterns, subpatterns, neighbours, zobrist):
+	"""
+	@param pos: the linear index of a box that was just pushed
+	@param boxes: bitset with the boxes positions
+	@param patterns: set with the zobrist hashes of the deadlock patterns
+	@param subpatterns: set with the zobrist hashes of the groups inside a pattern, see deadlock_pattern_keys
+	@param neighbours: list with the 8 positions around each position
+	Patterns are groups of boxes, each one next to (or diagonal to) another, so the ones with the pushed box
+	are found by growing groups from it, one box at a time, while the group is still part of some pattern
+	Returns a boolean value, True if the boxes around pos make a deadlock pattern
+	"""
+	key = zobrist[pos]
+	if key not in subpatterns:
+		return False
+	groups = [(key, (pos,))]
+	seen = {key}
+	while groups:
+		grown = []
+		for key, group in groups:
+			for cell in group:
+				for nxt in neighbours[cell]:
+					if boxes >> nxt & 1 and nxt not in group:
+						#the hash of a group is the same whatever the order its boxes were added
+						nxt_key = key ^ zobrist[nxt]
+						if nxt_key in seen:
+							continue
+						if nxt_key in patterns:
+							return True
+						seen.add(nxt_key)
+						if nxt_key in subpatterns:
+							grown.append((nxt_key, group + (nxt,)))
+		groups = grown
+	return False
+
+def min_cost_matching(costs):
+	"""
+	Hungarian algorithm, with potentials, for the minimum cost bipartite matching
+	@param costs: a list of n rows, each one with the cost of assigning that row to each of m >= n columns
+	Returns the minimum total cost of assigning every row to a different column
+	"""
+	n, m = len(costs), len(costs[0])
+	infinity = float("inf")
+	#potentials of rows and columns, p[j] is the row matched to column j and way[j] the previous column
+	#of j on the augmenting path, all 1-indexed so the column 0 can be the root of each path
+	u = [0] * (n + 1)
+	v = [0] * (m + 1)
+	p = [0] * (m + 1)
+	way = [0] * (m + 1)
+
+	for i in range(1, n + 1):
+		p[0] = i
+		j0 = 0
+		minv = [infinity] * (m + 1)
+		used = [False] * (m + 1)
+		while True:
+			used[j0] = True
+			i0 = p[j0]
+			row = costs[i0 - 1]
+			delta = infinity
+			j1 = 0
+			for j in range(1, m + 1):
+				if not used[j]:
+					cur = row[j - 1] - u[i0] - v[j]
+					if cur < minv[j]:
+						minv[j] = cur
+						way[j] = j0
+					if minv[j] < delta:
+						delta = minv[j]
+						j1 = j
+			for j in range(m + 1):
+				if used[j]:
+					u[p[j]] += delta
+					v[j] -= delta
+				else:
+					minv[j] -= delta
+			j0 = j1
+			if p[j0] == 0:
+				break
+		while j0:
+			j1 = way[j0]
+			p[j0] = p[j1]
+			j0 = j1
+
+	return sum(costs[p[j] - 1][j - 1] for j in range(1, m + 1) if p[j])
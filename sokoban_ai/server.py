@@ -5,6 +5,7 @@ import json
 import logging
 import os.path
 import random
+import time
 from collections import namedtuple
 from functools import reduce
 from operator import add
@@ -30,49 +31,175 @@ Player = namedtuple("Player", ["name", "ws"])
 HIGHSCORE_FILE = "highscores.json"
 
 
-class GameServer:
-    """Network Game Server."""
+class GameSession:
+    """A Game played by one player at a time, with its own frame clock and viewers."""
 
-    def __init__(self, level, timeout, grading=None):
-        self.game = Game(level, timeout)
-        self.players = asyncio.Queue()
+    def __init__(self, server, index):
+        self.server = server
+        self.index = index
+        self.game = Game(server._level, server._timeout)
         self.viewers = set()
+        # viewers that joined in the middle of a game, waiting for the whole state of the next frame
+        self.joining = set()
         self.current_player = None
+
+    async def send_info(self, game_info, highscores=False):
+        """Send game info to viewer and player."""
+        if highscores:
+            game_info["highscores"] = self.server._highscores
+            game_info["player"] = self.current_player.name
+
+        await self.broadcast(json.dumps(game_info))
+
+    async def broadcast(self, message, snapshot=None):
+        """Send a message to the player and the viewers of this session, the same string to all of them.
+
+           With the snapshot of a state, the viewers that are joining get it instead, and are then sent
+           the states of the next frames. The player gets it first and never waits for the viewers. A viewer
+           that fails to get it is dropped, it never ends the game of the player.
+        """
+        viewers = list(self.viewers)
+        joining = list(self.joining)
+        player_result, *results = await asyncio.gather(
+            self.current_player.ws.send(message),
+            *[client.send(message) for client in viewers],
+            *[client.send(message if snapshot is None else snapshot) for client in joining],
+            return_exceptions=True,
+        )
+        for viewer, result in zip(viewers + joining, results):
+            if isinstance(result, Exception):
+                logger.info("Dropping viewer of session %s: %s", self.index, result)
+                self.viewers.discard(viewer)
+                self.joining.discard(viewer)
+            elif snapshot is not None and viewer in self.joining:
+                self.joining.discard(viewer)
+                self.viewers.add(viewer)
+        # only the player leaving ends the game
+        if isinstance(player_result, BaseException):
+            raise player_result
+
+    async def play(self, player):
+        """Run a Game for a player, until it ends or the player disconnects."""
+        self.current_player = player
+        if self.current_player.ws.closed:
+            logger.error("<%s> disconnect while waiting", self.current_player.name)
+            return
+
+        try:
+            logger.info("Starting game for <%s> on session %s", self.current_player.name, self.index)
+            self.game = Game(self.server._level, self.server._timeout, self.current_player.name, self.server._headless)
+            self.server.sessions_by_player[self.current_player.ws] = self
+            start = time.perf_counter()
+
+            game_info = self.game.info()
+            await self.send_info(game_info)
+
+            if self.server.grading:
+                game_record = dict()
+                game_record["player"] = self.current_player.name
+                game_record["papertrail"] = self.game.papertrail
+
+            while self.game.running:
+                game_status = await self.game.next_frame()
+
+                if game_status == GameStatus.NEW_MAP:
+                    game_info = self.game.info()
+                    await self.send_info(game_info)
+
+                await self.broadcast(self.game.state, self.game.snapshot if self.joining else None)
+
+            elapsed = time.perf_counter() - start
+            logger.info(
+                "%s frames in %.2fs (%.1f fps), %s slipped",
+                self.game.frames,
+                elapsed,
+                self.game.frames / elapsed if elapsed else 0,
+                self.game.slipped_frames,
+            )
+            self.server.save_highscores(self.current_player.name, self.game.score)
+
+            game_info = self.game.info()
+            game_info["score"] = self.game.score
+            await self.send_info(game_info, highscores=True)
+
+            logger.info("Disconnecting <%s>", self.current_player.name)
+        except websockets.exceptions.ConnectionClosed:
+            self.current_player = None
+        finally:
+            try:
+                if self.server.grading:
+                    game_record["puzzles"], game_record["total_moves"], game_record["total_pushes"], game_record["total_steps"], game_record["box_on_goal"] = self.game.score
+                    game_record["papertrail"] = self.game.papertrail
+                    game_record["level"] = self.game.level
+                    requests.post(self.server.grading, json=game_record)
+            except RequestException as err:
+                logger.error(err)
+                logger.warning("Could not save score to server")
+
+            self.server.sessions_by_player.pop(player.ws, None)
+            if self.current_player:
+                await self.current_player.ws.close()
+
+    async def mainloop(self):
+        """Main loop, runing a Game for each player that waits on the server."""
+        while True:
+            logger.info("Session %s waiting for player", self.index)
+            await self.play(await self.server.players.get())
+
+
+class GameServer:
+    """Network Game Server, running a number of game sessions at the same time."""
+
+    def __init__(self, level, timeout, grading=None, headless=False, sessions=1, highscore_file=HIGHSCORE_FILE):
+        self.players = asyncio.Queue()
         self.grading = grading
         self._level = level
         self._timeout = timeout
+        self._headless = headless
+        self._highscore_file = highscore_file
+        self.sessions = [GameSession(self, index) for index in range(sessions)]
+        # session of each player websocket in a game
+        self.sessions_by_player = {}
 
         self._highscores = []
-        if os.path.isfile(HIGHSCORE_FILE):
-            with open(HIGHSCORE_FILE, "r") as infile:
+        if highscore_file and os.path.isfile(highscore_file):
+            with open(highscore_file, "r") as infile:
                 self._highscores = json.load(infile)
 
-    def save_highscores(self, score):
+    def save_highscores(self, name, score):
         """Update highscores, storing to file."""
         logger.debug("Save highscores")
         logger.info(
             "FINAL SCORE <%s>: %s puzzles with %s moves and %s pushes in %s steps, currently %s boxes on goal",
-            self.current_player.name,
+            name,
             *score,
         )
 
-        self._highscores.append((self.current_player.name, reduce_score(*score),))
+        self._highscores.append((name, reduce_score(*score),))
         self._highscores = sorted(self._highscores, key=lambda s: s[1])[:MAX_HIGHSCORES]
 
-        with open(HIGHSCORE_FILE, "w") as outfile:
-            json.dump(self._highscores, outfile)
-
-    async def send_info(self, game_info, highscores=False):
-        """Send game info to viewer and player."""
-        if highscores:
-            game_info["highscores"] = self._highscores
-            game_info["player"] = self.current_player.name
-
-        if self.viewers:
-            await asyncio.wait(
-                [client.send(json.dumps(game_info)) for client in self.viewers]
-            )
-        await self.current_player.ws.send(json.dumps(game_info))
+        if self._highscore_file:
+            with open(self._highscore_file, "w") as outfile:
+                json.dump(self._highscores, outfile)
+
+    def keypress(self, websocket, keys):
+        """Pass the key of a player to the game of its session."""
+        session = self.sessions_by_player.get(websocket)
+        if session is None:
+            return
+        logger.debug((session.current_player.name, keys))
+        if len(keys) > 0:
+            session.game.keypress(keys[0])
+        else:
+            session.game.keypress("")
+
+    def plan(self, websocket, keys):
+        """Pass the keys a player wants pressed on the next frames to the game of its session."""
+        session = self.sessions_by_player.get(websocket)
+        if session is None:
+            return
+        logger.debug((session.current_player.name, keys))
+        session.game.plan(keys)
 
     async def incomming_handler(self, websocket, path):
         """Process new clients arriving at the server."""
@@ -85,80 +212,39 @@ class GameServer:
                         await self.players.put(Player(data["name"], websocket))
 
                     if path == "/viewer":
-                        logger.info("Viewer connected")
-                        self.viewers.add(websocket)
-                        game_info = self.game.info()
+                        index = data.get("session", 0)
+                        if not isinstance(index, int) or not 0 <= index < len(self.sessions):
+                            logger.warning("Viewer asked for session %r, there are %s", index, len(self.sessions))
+                            await websocket.close()
+                            return
+                        session = self.sessions[index]
+                        logger.info("Viewer connected to session %s", session.index)
+                        game_info = session.game.info()
                         await websocket.send(json.dumps(game_info))
+                        # the states only have the boxes pushed on each frame, so in the middle of a game
+                        # it gets all of them with the next frame first (see GameSession.broadcast)
+                        if session.game.running:
+                            session.joining.add(websocket)
+                        else:
+                            session.viewers.add(websocket)
 
-                if data["cmd"] == "key" and self.current_player.ws == websocket:
-                    logger.debug((self.current_player.name, data))
-                    if len(data["key"]) > 0:
-                        self.game.keypress(data["key"][0])
-                    else:
-                        self.game.keypress("")
+                if data["cmd"] == "key":
+                    self.keypress(websocket, data["key"])
+
+                if data["cmd"] == "keys":
+                    self.plan(websocket, data["keys"])
 
         except websockets.exceptions.ConnectionClosed as closed_reason:
             logger.info("Client disconnected: %s", closed_reason)
-            if websocket in self.viewers:
-                self.viewers.remove(websocket)
+        finally:
+            # a viewer that closed cleanly ends the loop without an exception
+            for session in self.sessions:
+                session.viewers.discard(websocket)
+                session.joining.discard(websocket)
 
     async def mainloop(self):
-        """Main loop, runing the Game."""
-        while True:
-            logger.info("Waiting for player")
-            self.current_player = await self.players.get()
-
-            if self.current_player.ws.closed:
-                logger.error("<%s> disconnect while waiting", self.current_player.name)
-                continue
-
-            try:
-                logger.info("Starting game for <%s>", self.current_player.name)
-                self.game = Game(self._level, self._timeout, self.current_player.name)
-
-                game_info = self.game.info()
-                await self.send_info(game_info)
-
-                if self.grading:
-                    game_record = dict()
-                    game_record["player"] = self.current_player.name
-                    game_record["papertrail"] = self.game.papertrail
-
-                while self.game.running:
-                    game_status = await self.game.next_frame()
-
-                    if game_status == GameStatus.NEW_MAP:
-                        game_info = self.game.info()
-                        await self.send_info(game_info)
-
-                    state = self.game.state
-                    await self.current_player.ws.send(state)
-                    if self.viewers:
-                        await asyncio.wait(
-                            [client.send(state) for client in self.viewers]
-                        )
-                self.save_highscores(self.game.score)
-
-                game_info = self.game.info()
-                game_info["score"] = self.game.score
-                await self.send_info(game_info, highscores=True)
-
-                logger.info("Disconnecting <%s>", self.current_player.name)
-            except websockets.exceptions.ConnectionClosed:
-                self.current_player = None
-            finally:
-                try:
-                    if self.grading:
-                        game_record["puzzles"], game_record["total_moves"], game_record["total_pushes"], game_record["total_steps"], game_record["box_on_goal"] = self.game.score
-                        game_record["papertrail"] = self.game.papertrail
-                        game_record["level"] = self.game.level
-                        requests.post(self.grading, json=game_record)
-                except RequestException as err:
-                    logger.error(err)
-                    logger.warning("Could not save score to server")
-
-                if self.current_player:
-                    await self.current_player.ws.close()
+        """Main loop, runing the Game sessions."""
+        await asyncio.gather(*[session.mainloop() for session in self.sessions])
 
 
 if __name__ == "__main__":
@@ -170,6 +256,14 @@ if __name__ == "__main__":
     parser.add_argument(
         "--timeout", help="Timeout after this amount of steps", type=int, default=TIMEOUT
     )
+    parser.add_argument(
+        "--headless",
+        help="advance each frame as soon as the player sends its key, instead of at the game speed",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--sessions", help="games played at the same time, by different players", type=int, default=1
+    )
     parser.add_argument(
         "--grading-server",
         help="url of grading server",
@@ -180,7 +274,7 @@ if __name__ == "__main__":
     if args.seed > 0:
         random.seed(args.seed)
 
-    g = GameServer(args.level, args.timeout,args.grading_server)
+    g = GameServer(args.level, args.timeout, args.grading_server, args.headless, args.sessions)
 
     game_loop_task = asyncio.ensure_future(g.mainloop())
 
@@ -189,4 +283,4 @@ if __name__ == "__main__":
 
     loop = asyncio.get_event_loop()
     loop.run_until_complete(asyncio.gather(websocket_server, game_loop_task))
-    loop.close()
\ No newline at end of file
+    loop.close()
@@ -0,0 +1,180 @@
+"""Game Server Load Benchmarks."""
+import argparse
+import asyncio
+import contextlib
+import io
+import logging
+import sys
+import time
+
+from mapa import Map
+from game import Game, GAME_SPEED
+from server import GameServer, Player
+from AISokobanSolver import PackedTreeSearch
+
+
+class BenchmarkClient:
+    """Stands for the websocket of a client, counting what the server sends to it."""
+
+    def __init__(self):
+        self.closed = False
+        self.messages = 0
+        self.bytes = 0
+
+    async def send(self, message):
+        """Receive a message from the server."""
+        self.messages += 1
+        self.bytes += len(message)
+
+    async def close(self):
+        """Disconnect from the server."""
+        self.closed = True
+
+
+class FailingClient(BenchmarkClient):
+    """A viewer whose connection goes away after a number of messages, so every send after it fails."""
+
+    def __init__(self, messages):
+        super().__init__()
+        self.fails_after = messages
+
+    async def send(self, message):
+        if self.messages >= self.fails_after:
+            self.closed = True
+            raise ConnectionResetError("viewer went away")
+        await super().send(message)
+
+
+class BenchmarkPlayer(BenchmarkClient):
+    """A player that answers every message with the next key of its plan.
+
+       With batched, it sends the whole plan on the first message instead, same as student.py.
+    """
+
+    def __init__(self, server, keys, batched=False):
+        super().__init__()
+        self.server = server
+        self.keys = list(keys)
+        self.batched = batched
+        # messages sent to the server
+        self.sent = 0
+
+    async def send(self, message):
+        await super().send(message)
+        if self.batched:
+            if self.keys:
+                self.sent += 1
+                self.server.plan(self, self.keys)
+                self.keys = []
+        else:
+            self.sent += 1
+            self.server.keypress(self, self.keys.pop(0) if self.keys else "")
+
+
+def solution(level):
+    """Keys that solve a level."""
+    level_file = f"levels/{level}.xsb"
+    with contextlib.redirect_stdout(io.StringIO()):
+        return PackedTreeSearch(Map(level_file), level_file).search()
+
+
+async def run_sessions(sessions, level, seconds, keys, viewers=0, batched=False, failing_viewers=0):
+    """Play a game on each of a number of sessions of the same server at the same time.
+
+       Every game lasts about seconds at GAME_SPEED, its player plays keys and then waits,
+       while a number of viewers watch each session. Another failing_viewers per session go
+       away halfway through the game, which must not end it.
+    """
+    server = GameServer(level, int(seconds * GAME_SPEED), sessions=sessions, highscore_file=None)
+    players = [BenchmarkPlayer(server, keys, batched) for _ in range(sessions)]
+    clients = list(players)
+    for session in server.sessions:
+        session.viewers = {BenchmarkClient() for _ in range(viewers)}
+        session.viewers.update(FailingClient(int(seconds * GAME_SPEED) // 2) for _ in range(failing_viewers))
+        clients.extend(session.viewers)
+
+    async def join(index):
+        # players don't all join at the same time, their frames are spread over the time of a frame
+        await asyncio.sleep(index / sessions / GAME_SPEED)
+        await server.sessions[index].play(Player(f"player{index}", players[index]))
+
+    start, cpu = time.perf_counter(), time.process_time()
+    await asyncio.gather(*[join(index) for index in range(sessions)])
+    elapsed, cpu = time.perf_counter() - start, time.process_time() - cpu
+
+    frames = sum(session.game.frames for session in server.sessions)
+    slipped = sum(session.game.slipped_frames for session in server.sessions)
+    return {
+        "sessions": sessions,
+        "frames": frames,
+        "fps": frames / elapsed / sessions,
+        "slipped": slipped / frames if frames else 0,
+        "max_lag": max(session.game.max_lag for session in server.sessions),
+        "cpu_per_frame": cpu / frames if frames else 0,
+        "bytes_per_frame": sum(client.bytes for client in clients) / frames if frames else 0,
+        "player_messages": sum(player.sent for player in players) / frames if frames else 0,
+        "scores": [session.game.score for session in server.sessions],
+        # players that got their final score and were disconnected by the server
+        "finished": sum(player.closed for player in players),
+    }
+
+
+async def frame_cost(level, frames):
+    """Average seconds of a frame of a headless game, with its state, on a level.
+
+       The keeper walks around the level and pushes whatever is in its way, the player
+       always answers before the frame, so there's no waiting.
+    """
+    game = Game(level, frames + 1, "player", headless=True)
+    start = time.perf_counter()
+    for frame in range(frames):
+        game.keypress("wasd"[frame // 3 % 4])
+        await game.next_frame()
+        game.state
+    return (time.perf_counter() - start) / frames
+
+
+def print_load(results, max_slipped):
+    """Print the load results as a table, with the most sessions that kept up with GAME_SPEED."""
+    print(
+        f"{'sessions':>8} {'frames':>8} {'fps':>6} {'slipped':>8} {'max lag':>8} {'cpu/frame':>10} {'bytes/frame':>12} {'msgs/frame':>11} {'finished':>9}"
+    )
+    for r in results:
+        print(
+            f"{r['sessions']:>8} {r['frames']:>8} {r['fps']:>6.2f} {r['slipped'] * 100:>7.2f}% "
+            f"{r['max_lag'] * 1000:>6.1f}ms {r['cpu_per_frame'] * 1e6:>8.0f}us {r['bytes_per_frame']:>12.0f} {r['player_messages']:>11.3f} {r['finished']:>9}"
+        )
+    sustained = [r["sessions"] for r in results if r["slipped"] <= max_slipped]
+    print(f"\nsessions at {GAME_SPEED} fps with at most {max_slipped:.0%} slipped frames: {max(sustained, default=0)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sessions", nargs="+", type=int, default=[1, 10, 50, 100, 200], help="concurrent sessions to try"
+    )
+    parser.add_argument("--level", help="level played on every session", type=int, default=4)
+    parser.add_argument("--seconds", help="length of each game", type=float, default=10)
+    parser.add_argument("--viewers", help="viewers watching each session", type=int, default=0)
+    parser.add_argument(
+        "--failing-viewers", help="viewers of each session that go away halfway through the game", type=int, default=0
+    )
+    parser.add_argument("--batched", help="players send all their keys at once", action="store_true")
+    parser.add_argument(
+        "--frame-level", help="time the frames of a headless game on this level instead, e.g. 68a"
+    )
+    parser.add_argument("--frames", help="frames timed with --frame-level", type=int, default=100000)
+    parser.add_argument(
+        "--max-slipped", help="fraction of slipped frames a number of sessions can sustain", type=float, default=0.01
+    )
+    args = parser.parse_args()
+
+    # the server and game logs would be most of the work
+    logging.disable(logging.INFO)
+    if args.frame_level:
+        cost = asyncio.run(frame_cost(args.frame_level, args.frames))
+        print(f"levels/{args.frame_level}.xsb: {cost * 1e6:.1f}us per frame")
+        sys.exit()
+
+    keys = solution(args.level)
+    print_load([asyncio.run(run_sessions(n, args.level, args.seconds, keys, args.viewers, args.batched, args.failing_viewers)) for n in args.sessions], args.max_slipped)
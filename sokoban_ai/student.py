@@ -5,19 +5,16 @@ import sys
 import websockets
 from mapa import Map
 from AISokobanSolver import *
+import portfolio
 
 async def solver(map_queue, solver_queue):
     while True:
         game_properties = await map_queue.get()
         mapa = Map(game_properties["map"])
 
-        t = TreeSearch(mapa, game_properties['map'])
-
-        while True:
-            await asyncio.sleep(0)
-            break
-        
-        keys = await t.search()
+        #race the solver configurations on other processes, the first solution wins,
+        #agent_loop keeps receiving every frame meanwhile
+        keys = await portfolio.solve_async(str(mapa), game_properties['map'])
         
         await solver_queue.put(keys)
 
@@ -37,21 +34,15 @@ async def agent_loop(map_queue, solver_queue, server_address="localhost:8000", a
                 if "map" in update:
                     # new level
                     game_properties = update
-                    keys = ""
                     await map_queue.put(game_properties)
 
+                #the server presses the keys of the solution one per frame, so they are sent only once
                 if not solver_queue.empty():
                     keys = await solver_queue.get()
-
-                key = ""
-
-                if len(keys):
-                    key = keys[0]
-                    keys = keys[1:]
-
-                await websocket.send(
-                    json.dumps({"cmd": "key", "key": key})
-                )
+                    if keys:
+                        await websocket.send(
+                            json.dumps({"cmd": "keys", "keys": keys})
+                        )
 
             except websockets.exceptions.ConnectionClosedOK:
                 print("Server has cleanly disconnected us")
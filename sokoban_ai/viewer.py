@@ -49,10 +49,10 @@ SPRITES = None
 SCREEN = None
 
 
-async def messages_handler(websocket_path, queue):
-    """Handles server side messages, putting them into a queue."""
+async def messages_handler(websocket_path, queue, session=0):
+    """Handles server side messages of a game session, putting them into a queue."""
     async with websockets.connect(websocket_path) as websocket:
-        await websocket.send(json.dumps({"cmd": "join"}))
+        await websocket.send(json.dumps({"cmd": "join", "session": session}))
 
         while True:
             update = await websocket.recv()
@@ -197,6 +197,8 @@ async def main_loop(queue):
         "keeper": mapa.keeper,
         "boxes": mapa.boxes,
     }
+    # the boxes of the game, states have them all on a new level and then only the pushed ones
+    boxes = mapa.boxes
 
     new_event = True
     while True:
@@ -223,9 +225,14 @@ async def main_loop(queue):
                 color=(200, 20, 20),
             )
 
-        if "boxes" in state:
+        if new_event and ("boxes" in state or "moved" in state):
+            if "boxes" in state:
+                boxes = [tuple(box) for box in state["boxes"]]
+            for old, new in state.get("moved", []):
+                boxes.remove(tuple(old))
+                boxes.append(tuple(new))
             boxes_group.empty()
-            for box in state["boxes"]:
+            for box in boxes:
                 boxes_group.add(
                     Box(
                         pos=box,
@@ -319,6 +326,7 @@ if __name__ == "__main__":
         "--scale", help="reduce size of window by x times", type=int, default=1
     )
     parser.add_argument("--port", help="TCP port", type=int, default=PORT)
+    parser.add_argument("--session", help="game session to watch", type=int, default=0)
     arguments = parser.parse_args()
     SCALE = arguments.scale
 
@@ -332,7 +340,7 @@ if __name__ == "__main__":
 
     try:
         LOOP.run_until_complete(
-            asyncio.gather(messages_handler(ws_path, q), main_loop(q))
+            asyncio.gather(messages_handler(ws_path, q, arguments.session), main_loop(q))
         )
     except RuntimeError as err:
         logger.error(err)